@@ -0,0 +1,95 @@
+'''
+Benchmark of representative statement fact queries on a synthetic SQLite database.
+
+Builds a database of num_tickers x num_items x num_dates facts (1 million by default)
+through DbInterface.addStatementFacts, then times:
+    - cross section:  one line item for every company at one date
+    - item series:    one line item for every company across all dates
+    - company:        every fact for one company (DbInterface.getStatements)
+    - statement:      one statement for the whole exchange (DbInterface.getStatements)
+Each query is run with the current schema and again after dropping the line item/date 
+index, to show what the index buys.
+Run from the financial_data_handling folder, e.g.
+    python -m benchmarks.db_queries bench.db 2000 50 10
+'''
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, select, text
+
+from store.db_wrapper import Base, DbInterface, Company, Exchange, Statement, LineItem, StatementItem, StatementFact
+
+
+def build_synthetic(db_path, num_tickers = 2000, num_items = 50, num_dates = 10):
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    engine = create_engine("sqlite:///" + db_path)
+    Base.metadata.create_all(engine)
+    tickers = ["T{:04d}".format(i) for i in range(num_tickers)]
+    items = ["Item{:03d}".format(i) for i in range(num_items)]
+    with engine.begin() as connection:
+        connection.execute(Exchange.__table__.insert(), [{"symbol" : "ASX", "name" : "ASX", "country" : "Australia", "currency" : "AUD"}])
+        connection.execute(Company.__table__.insert(), [{"ticker" : ticker, "exchange" : "ASX", "name" : ticker} for ticker in tickers])
+        connection.execute(Statement.__table__.insert(), [{"type" : "Income"}, {"type" : "Balance"}])
+        connection.execute(LineItem.__table__.insert(), [{"id" : i + 1, "name" : item} for i, item in enumerate(items)])
+        connection.execute(StatementItem.__table__.insert(), [
+            {"statement_type" : "Income" if i < num_items // 2 else "Balance", "line_item_id" : i + 1, "row_num" : i} 
+            for i in range(num_items)])
+    dates = pd.date_range("2008-12-31", periods = num_dates, freq = "12ME")
+    facts = pd.DataFrame({
+        "ticker" : np.repeat(tickers, num_items * num_dates), 
+        "period" : "annual", 
+        "line_item" : np.tile(np.repeat(items, num_dates), num_tickers), 
+        "date" : np.tile(dates, num_tickers * num_items), 
+        "value" : np.random.default_rng(0).normal(100, 20, num_tickers * num_items * num_dates)})
+    db = DbInterface(engine)
+    start = time.perf_counter()
+    db.addStatementFacts(facts)
+    seconds = time.perf_counter() - start
+    print("Loaded {:,} facts in {:.1f}s ({:,.0f} facts/s)".format(len(facts), seconds, len(facts) / seconds))
+    return db, tickers, dates
+
+
+def queries(db, tickers, dates):
+    line_item_id = db.lineItemIds()["Item001"]
+    cross_section = select(StatementFact.ticker, StatementFact.value).where(
+        StatementFact.line_item_id == line_item_id).where(StatementFact.period == "annual").where(
+        StatementFact.date == dates[-1].date())
+    item_series = select(StatementFact.ticker, StatementFact.date, StatementFact.value).where(
+        StatementFact.line_item_id == line_item_id)
+
+    def run_query(query):
+        with db.engine.connect() as connection:
+            return len(connection.execute(query).all())
+
+    return [("cross section", lambda: run_query(cross_section)), 
+            ("item series", lambda: run_query(item_series)), 
+            ("company", lambda: len(db.getStatements(["Income", "Balance"], [tickers[len(tickers) // 2]]))), 
+            ("statement", lambda: len(db.getStatements(["Income"])))]
+
+
+def time_queries(label, db, tickers, dates, repeats = 3):
+    print(label)
+    for name, query in queries(db, tickers, dates):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            rows = query()
+            times.append(time.perf_counter() - start)
+        print("  {:<14} {:>8} rows  {:>9.4f}s".format(name, rows, min(times)))
+
+
+def run(db_path = "bench.db", num_tickers = 2000, num_items = 50, num_dates = 10):
+    db, tickers, dates = build_synthetic(db_path, num_tickers, num_items, num_dates)
+    time_queries("Current schema", db, tickers, dates)
+    with db.engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_statement_fact_line_item_date"))
+    time_queries("Without line item/date index", db, tickers, dates)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    db_path = args[0] if args else "bench.db"
+    run(db_path, *[int(arg) for arg in args[1:]])
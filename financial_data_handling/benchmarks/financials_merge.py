@@ -0,0 +1,113 @@
+'''
+Benchmark of merging downloaded Financials into stored Financials.
+
+Builds synthetic stored and downloaded Financials for num_tickers tickers across both
+annual and interim periods, where each download overlaps the stored periods. Times the
+original approach (Financials.merge and as_long_format as they were, sheet by sheet
+and table by table with column label list comprehensions) against merge_financials, 
+which merges the whole batch in one pass, and checks both give the same facts.
+Run from the financial_data_handling folder, e.g.
+    python -m benchmarks.financials_merge 2000
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from formats.fundamentals import Financials, merge_financials, period_dates, numeric_values
+
+
+TABLES = {"income" : ["income"],
+          "balance" : ["assets", "liabilities"],
+          "cashflow" : ["operating", "financing", "investing"]}
+
+
+def period_labels(period, first_year, num_periods):
+    if period == "annual":
+        return [str(year) for year in range(first_year + num_periods - 1, first_year - 1, -1)]
+    ends = pd.date_range(str(first_year), periods = num_periods, freq = "QE")[::-1]
+    return [end.strftime("%d-%b-%Y") for end in ends]
+
+
+def synthetic_financials(ticker, period, labels, num_items = 40):
+    financials = Financials(ticker, period)
+    for sheet, tables in TABLES.items():
+        financials.statements[sheet] = {}
+        for table in tables:
+            values = np.random.rand(num_items, len(labels)) * 1000
+            financials.statements[sheet][table] = pd.DataFrame(
+                values.round(1).astype(str).astype(object),
+                index = ["{0} item {1}".format(table, i) for i in range(num_items)],
+                columns = labels)
+    return financials
+
+
+def legacy_merge(stored, new):
+    for sheet in new.statements:
+        try:
+            existing_sheet = stored.statements[sheet]
+        except KeyError:
+            stored.statements[sheet] = new.statements[sheet]
+        else:
+            for table in new.statements[sheet]:
+                existing = existing_sheet[table]
+                joined = new.statements[sheet][table]
+                existing_years = existing.columns.tolist()
+                new_years = joined.columns.tolist()
+                append_years = [year not in new_years for year in existing_years]
+                stored.statements[sheet][table] = pd.concat([joined, existing.iloc[:, append_years]], axis = 1)
+
+
+def legacy_long_format(financials):
+    frames = []
+    for sheet in financials.statements:
+        for table_name, table in financials.statements[sheet].items():
+            num_items, num_dates = table.shape
+            frames.append(pd.DataFrame({
+                "ticker" : financials.ticker, 
+                "period" : financials.period, 
+                "statement" : sheet, 
+                "table" : table_name, 
+                "line_item" : np.repeat(table.index.astype(str), num_dates), 
+                "date" : np.tile(period_dates(table.columns, financials.period), num_items), 
+                "value" : numeric_values(table.values.ravel())}))
+    return pd.concat(frames, ignore_index = True)
+
+
+def build(num_tickers):
+    stored, downloaded = [], []
+    for i in range(num_tickers):
+        ticker = "T{:04d}".format(i)
+        for period, first_year in [("annual", 2010), ("interim", 2014)]:
+            stored.append(synthetic_financials(ticker, period, period_labels(period, first_year, 5)))
+            downloaded.append(synthetic_financials(ticker, period, period_labels(period, first_year + 3, 5)))
+    return stored, downloaded
+
+
+def sorted_facts(panel):
+    columns = ["ticker", "period", "statement", "table", "line_item", "date"]
+    return panel.sort_values(columns, ignore_index = True)
+
+
+if __name__ == "__main__":
+    num_tickers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("Building {} tickers x 2 periods...".format(num_tickers))
+    stored, downloaded = build(num_tickers)
+
+    start = time.time()
+    panel = merge_financials(stored, downloaded)
+    batch_time = time.time() - start
+
+    start = time.time()
+    frames = []
+    for existing, new in zip(stored, downloaded):
+        legacy_merge(existing, new)
+        frames.append(legacy_long_format(existing))
+    legacy_panel = pd.concat(frames, ignore_index = True)
+    legacy_time = time.time() - start
+
+    print("Facts merged:     {:,}".format(len(panel)))
+    print("Legacy merge:     {:.2f}s".format(legacy_time))
+    print("merge_financials: {:.2f}s ({:.1f}x)".format(batch_time, legacy_time / batch_time))
+    same = sorted_facts(panel).equals(sorted_facts(legacy_panel))
+    print("Results match:    {}".format(same))
@@ -0,0 +1,89 @@
+'''
+Throughput benchmark for statement scraping.
+
+Scrapes a local corpus of saved StatementWebpage html files, first serially on 
+one process and then through a ScrapePool, and reports pages per second for each.
+Run from the financial_data_handling folder, e.g.
+    python -m benchmarks.scraping ASX D:\\Investing\\ 500
+'''
+import os
+import sys
+import time
+
+from store.file_system import Storage
+from download.financials import STATEMENT_SHEETS, WSJscraper, scrape_pages
+from download.pool import ScrapePool
+
+
+def find_statement_pages(store, limit = None):
+    '''
+    Returns a list of (sheet, file_path) for saved statement pages under the store's data folder.
+    '''
+    pages = []
+    for ticker in os.listdir(store.data):
+        for period_folder in ["Annual", "Interim"]:
+            folder = os.path.join(store.data, ticker, "Financials", period_folder)
+            if not os.path.isdir(folder):
+                continue
+            for sheet in STATEMENT_SHEETS:
+                file_path = os.path.join(folder, ticker + sheet + ".html")
+                if os.path.exists(file_path):
+                    pages.append((sheet, file_path))
+            if limit is not None and len(pages) >= limit:
+                return pages[:limit]
+    return pages
+
+
+def read_corpus(pages):
+    corpus = []
+    for sheet, file_path in pages:
+        with open(file_path, 'r') as file:
+            corpus.append((sheet, file.read()))
+    return corpus
+
+
+def scrape_serial(corpus):
+    scraper = WSJscraper()
+    failures = 0
+    for sheet, html in corpus:
+        try:
+            scraper.getTables(sheet, html)
+        except Exception:
+            failures += 1
+    return failures
+
+
+def scrape_parallel(corpus, workers = None):
+    jobs = ((i, ({sheet : html},)) for i, (sheet, html) in enumerate(corpus))
+    failures = 0
+    for key, scraped, error in ScrapePool(workers).pipeline(scrape_pages, jobs):
+        if error is not None or any(result[1] is not None for result in scraped.values()):
+            failures += 1
+    return failures
+
+
+def report(label, num_pages, seconds, failures):
+    print("{:<12} {:>6} pages in {:>8.2f}s  {:>8.1f} pages/s  ({} failed)".format(
+        label, num_pages, seconds, num_pages / seconds, failures))
+
+
+def run(exchange = "ASX", root_folder = "D:\\Investing\\", limit = None, workers = None):
+    store = Storage(exchange, root_folder)
+    corpus = read_corpus(find_statement_pages(store, limit))
+    if not corpus:
+        print("No saved statement pages found under " + store.data)
+        return
+    start = time.perf_counter()
+    failures = scrape_serial(corpus)
+    report("serial", len(corpus), time.perf_counter() - start, failures)
+    start = time.perf_counter()
+    failures = scrape_parallel(corpus, workers)
+    report("process pool", len(corpus), time.perf_counter() - start, failures)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    exchange = args[0] if len(args) > 0 else "ASX"
+    root_folder = args[1] if len(args) > 1 else "D:\\Investing\\"
+    limit = int(args[2]) if len(args) > 2 else None
+    run(exchange, root_folder, limit)
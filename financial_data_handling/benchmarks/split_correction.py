@@ -0,0 +1,85 @@
+'''
+Benchmark of split error correction in Adj Close.
+
+Compares the original loop based Handler.clean_adj_close (reproduced below, with
+.loc assignment in place of the chained assignment current pandas ignores) against
+the vectorized split_divisors engine, on synthetic price series containing many 
+split errors. Also times the batched correction across a whole cube of tickers.
+Run from the financial_data_handling folder, e.g.
+    python -m benchmarks.split_correction 5000 50 200
+'''
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import DateOffset
+
+from download.adjustments import split_divisors, clean_adj_close
+
+
+def legacy_clean_adj_close(instrument, limit = 3.0):
+    instrument = instrument.copy()
+    adj_ratios = instrument["Adj Close"] / instrument["Adj Close"].shift(1)
+    close_ratios = instrument["Close"] / instrument["Close"].shift(1)
+    possible_errors = adj_ratios > limit
+    while any(possible_errors):
+        try:
+            start = adj_ratios[possible_errors].index[0]
+            ix = 0
+            end = adj_ratios[adj_ratios < (1 / limit)].index[ix]
+            while end < start:
+                ix += 1
+                end = adj_ratios[adj_ratios < (1 / limit)].index[ix]
+        except IndexError:
+            possible_errors[start] = False
+        else:
+            if (1 / limit) < close_ratios[end] < limit:
+                divisor = round(adj_ratios[start])
+                instrument.loc[start:(end - DateOffset(1)), "Adj Close"] /= divisor
+                adj_ratios = instrument["Adj Close"] / instrument["Adj Close"].shift(1)
+                possible_errors = adj_ratios > limit
+            else:
+                possible_errors[start] = False
+    return instrument
+
+
+def synthetic_series(num_dates, num_splits, seed = 0):
+    '''
+    A random walk price series where Adj Close has num_splits non-overlapping 
+    periods multiplied up by a missed split factor.
+    '''
+    random = np.random.default_rng(seed)
+    dates = pd.bdate_range("2000-01-03", periods = num_dates)
+    close = 10 * np.cumprod(1 + random.normal(0, 0.01, num_dates))
+    adj_close = close * 0.95
+    bounds = np.sort(random.choice(np.arange(1, num_dates - 1), 2 * num_splits, replace = False))
+    for start, end in bounds.reshape(-1, 2):
+        adj_close[start:end] *= random.integers(4, 10)
+    return pd.DataFrame({"Close" : close, "Adj Close" : adj_close}, index = dates)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run(num_dates = 5000, num_splits = 50, num_tickers = 200):
+    series = synthetic_series(num_dates, num_splits)
+    legacy, legacy_time = timed(legacy_clean_adj_close, series)
+    vectorized, vector_time = timed(clean_adj_close, series)
+    matches = np.allclose(legacy["Adj Close"], vectorized["Adj Close"])
+    print("{} dates, {} splits".format(num_dates, num_splits))
+    print("  loop:       {:>9.4f}s".format(legacy_time))
+    print("  vectorized: {:>9.4f}s  ({:.0f}x, results match: {})".format(vector_time, legacy_time / vector_time, matches))
+
+    cube = [synthetic_series(num_dates, num_splits, seed) for seed in range(num_tickers)]
+    adj_close = np.stack([frame["Adj Close"].values for frame in cube])
+    close = np.stack([frame["Close"].values for frame in cube])
+    _, batch_time = timed(split_divisors, adj_close, close)
+    print("  batched over {} tickers: {:.4f}s".format(num_tickers, batch_time))
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*args)
@@ -0,0 +1,80 @@
+import numpy as np
+
+
+SPLIT_LIMIT = 3.0
+
+
+def previous_valid(values, valid):
+    '''
+    For an array of series x dates, returns the last value before each date where
+    valid is True in the same series (NaN where there is none).
+    '''
+    positions = np.where(valid, np.arange(values.shape[1]), -1)
+    positions = np.maximum.accumulate(positions, axis = 1)
+    previous = np.full(values.shape, -1)
+    previous[:, 1:] = positions[:, :-1]
+    result = np.take_along_axis(values, np.maximum(previous, 0), axis = 1)
+    result[previous < 0] = np.nan
+    return result
+
+
+def split_divisors(adj_close, close, limit = SPLIT_LIMIT):
+    '''
+    Finds Adj Close values which are out of line with Close because a stock split
+    has not been carried through the adjusted series, and returns the divisors 
+    which correct them (1 where no correction is needed).
+
+    adj_close and close are arrays of series x dates; a 1D array is treated as a 
+    single series. A spike starts where Adj Close jumps by more than limit and ends 
+    at the next drop by more than limit in the same series. The pair is treated as 
+    a split error when Close does not also move at the end of the spike, otherwise 
+    it may be a genuine spike in the data. Each spike end corrects only the earliest 
+    start pointing to it.
+    Missing values (e.g. dates on which a series did not trade, in a cube over the 
+    union of several series' dates) are skipped: each value is compared with the 
+    last valid value before it in its series.
+    All spike pairs across all series are found in one pass and the divisors are 
+    built with a single cumulative product, so the cost is linear in the data size.
+    '''
+    adj_close = np.atleast_2d(np.asarray(adj_close, dtype = float))
+    close = np.atleast_2d(np.asarray(close, dtype = float))
+    num_dates = adj_close.shape[1]
+    valid = ~(np.isnan(adj_close) | np.isnan(close))
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        adj_ratios = np.where(valid, adj_close / previous_valid(adj_close, valid), np.nan)
+        close_ratios = np.where(valid, close / previous_valid(close, valid), np.nan)
+    adj_ratios = adj_ratios.ravel()
+    close_ratios = close_ratios.ravel()
+
+    # Positions are flat indices into the series x dates array, so sorted order
+    # runs through each series in turn.
+    starts = np.flatnonzero(adj_ratios > limit)
+    ends = np.flatnonzero(adj_ratios < (1 / limit))
+    steps = np.ones(adj_close.size)
+    if starts.size and ends.size:
+        next_end = np.searchsorted(ends, starts, side = "right")
+        has_end = next_end < ends.size
+        starts = starts[has_end]
+        ends = ends[next_end[has_end]]
+        same_series = (starts // num_dates) == (ends // num_dates)
+        # Close in sync at the spike end indicates Adj Close is out of sync with Close.
+        in_sync = (close_ratios[ends] > (1 / limit)) & (close_ratios[ends] < limit)
+        starts = starts[same_series & in_sync]
+        ends = ends[same_series & in_sync]
+        ends, first_start = np.unique(ends, return_index = True)
+        starts = starts[first_start]
+        divisors = np.round(adj_ratios[starts])
+        np.multiply.at(steps, starts, divisors)
+        np.divide.at(steps, ends, divisors)
+    return np.cumprod(steps.reshape(adj_close.shape), axis = 1)
+
+
+def clean_adj_close(instrument, limit = SPLIT_LIMIT):
+    '''
+    Takes a dataframe [OHLCV & Adj Close] for a ticker and returns a copy
+    with Adj Close corrected for any split errors.
+    '''
+    divisors = split_divisors(instrument["Adj Close"].values, instrument["Close"].values, limit)[0]
+    cleaned = instrument.copy()
+    cleaned["Adj Close"] = instrument["Adj Close"] / divisors
+    return cleaned
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import random
+import threading
+
+import requests
+
+from formats import temporary_path, replace_file
+
+
+# Statuses which indicate a temporary problem with the source, worth retrying.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Statuses where the source is asking us to slow down.
+THROTTLE_STATUSES = {429, 503}
+
+
+class CircuitOpenError(IOError):
+    pass
+
+
+def response_status(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_transient(error):
+    '''
+    Whether an error from a fetch is likely to succeed if retried, i.e. a connection
+    failure, timeout or one of the RETRY_STATUSES.
+    '''
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return response_status(error) in RETRY_STATUSES
+
+
+def is_throttled(error):
+    return response_status(error) in THROTTLE_STATUSES
+
+
+class TokenBucket():
+    '''
+    Allows rate requests per second on average, with bursts of up to burst requests.
+    The rate adapts to the source: it is halved when the source throttles requests
+    and recovers by a tenth of max_rate with each success, so requests run at close
+    to the highest rate the source tolerates. A rate of None or 0 is unlimited.
+    '''
+    def __init__(self, rate, burst = 1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        '''
+        Takes a token, returning how long to wait before it may be used.
+        '''
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def slow_down(self):
+        if self.rate:
+            self.rate = max(self.max_rate / 32.0, self.rate / 2.0)
+
+    def speed_up(self):
+        if self.rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10.0)
+
+
+class CircuitBreaker():
+    '''
+    Opens after threshold consecutive failed calls (each having used up its retries),
+    failing calls immediately for cooldown seconds. After the cooldown calls are let through again and the first success
+    closes the circuit.
+    '''
+    def __init__(self, threshold = 5, cooldown = 60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+
+    def check(self, host):
+        if self.opened is not None and time.monotonic() - self.opened < self.cooldown:
+            raise CircuitOpenError("Too many failures from {}, paused for {:.0f}s".format(host, self.cooldown))
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = time.monotonic()
+
+
+class FetchPolicy():
+    '''
+    FetchPolicy is shared by the downloaders to decide when and how often each host is
+    called. Every call to a host takes a token from its TokenBucket, transient errors
+    are retried up to retries times with exponential backoff and full jitter (a random
+    wait of up to backoff * 2^attempt, capped at max_backoff), and each host has a
+    CircuitBreaker so that a source which is down fails fast rather than being retried
+    for every ticker. Only calls which fail after all their retries count towards the
+    breaker, and errors which are not transient (e.g. an unknown ticker) count as the
+    host responding.
+    The rate limits and breakers are held per process: a policy sent to worker
+    processes (e.g. with a Handler to a ScrapePool) gives each worker its own buckets,
+    so the host sees up to requests_per_second times the number of workers. Calls to
+    a source should be made from the process owning the policy where that matters.
+    '''
+    def __init__(self, requests_per_second = 4.0, burst = 1, retries = 4, backoff = 0.5,
+                 max_backoff = 30.0, failure_threshold = 5, cooldown = 60.0):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.buckets = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to worker processes with a Handler; each process keeps its own buckets
+        # and breakers, so rate limits are not shared across processes.
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def host_state(self, host):
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.requests_per_second, self.burst)
+            self.breakers[host] = CircuitBreaker(self.failure_threshold, self.cooldown)
+        return (self.buckets[host], self.breakers[host])
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, host, function, *args, transient = is_transient, **kwargs):
+        '''
+        Calls function(*args, **kwargs) against host under the policy, returning its
+        result. transient decides which errors are retried. The last error is raised
+        once retries are exhausted, or CircuitOpenError while the host is paused.
+        '''
+        attempt = 0
+        while True:
+            with self.lock:
+                bucket, breaker = self.host_state(host)
+                breaker.check(host)
+                delay = bucket.reserve()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as E:
+                if not transient(E):
+                    with self.lock:
+                        breaker.success()
+                    raise
+                with self.lock:
+                    if is_throttled(E):
+                        bucket.slow_down()
+                    if attempt >= self.retries:
+                        breaker.failure()
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff_delay(attempt))
+                attempt += 1
+            else:
+                with self.lock:
+                    breaker.success()
+                    bucket.speed_up()
+                return result
+
+
+class RetryQueue():
+    '''
+    A persistent record of the jobs which failed in each task (e.g. "prices" or
+    "financials-annual"), kept in a JSON file so that a rerun need only repeat the
+    failures. Each task maps a key (usually a ticker) to its last error.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as file:
+                self.tasks = json.load(file)
+        except FileNotFoundError:
+            self.tasks = {}
+
+    def pending(self, task):
+        return sorted(self.tasks.get(task, {}))
+
+    def record(self, task, keys, errors):
+        '''
+        Updates task with the outcome of attempting keys: those in errors are queued
+        with their error, the rest are removed. The queue is saved straight away.
+        '''
+        with self.lock:
+            failures = self.tasks.setdefault(task, {})
+            for key in keys:
+                if key in errors:
+                    failures[key] = str(errors[key])
+                else:
+                    failures.pop(key, None)
+            if not failures:
+                del self.tasks[task]
+            self.save()
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        temp_path = temporary_path(self.path)
+        with open(temp_path, 'w') as file:
+            json.dump(self.tasks, file, indent = 1, sort_keys = True)
+        replace_file(temp_path, self.path)
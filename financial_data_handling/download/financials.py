@@ -1,5 +1,7 @@
 import requests
 import os
+import io
+import re
 import shutil
 import pandas
 import datetime
@@ -7,92 +9,199 @@ import pickle
 from pandas_datareader import data as pd_data
 from pandas_datareader import base as pd_base
 from bs4 import BeautifulSoup
+import lxml.html
 
-from formats.fundamentals import Financials
+from formats.fundamentals import Financials, StatementWebpage
+from formats.price_history import PriceHistory
 from store.file_system import Storage
-from .prices import YahooDataDownloader
+from .prices import YahooDataDownloader, PriceDownloader, Handler
+from .pool import DownloadPool, ScrapePool, RateLimitedSession
+from .fetch_policy import FetchPolicy, RetryQueue
+from .response_cache import ResponseCache, CachedPage, RESPONSE_CACHE_FILENAME
+
+
+STATEMENT_SHEETS = ["income", "balance", "cashflow"]
+RETRY_QUEUE_FILENAME = "retry_queue.json"
 
 
 
 # TODO Download handlers need to move into download.__init__.py or separate module.
 class WebDownloader():
     
-    def __init__(self, exchange = "ASX"):
+    def __init__(self, exchange = "ASX", workers = 8, requests_per_second = 4.0, scrape_workers = None):
         self.store = Storage(exchange)
-        self.WSJ = WSJinternet(exchange)
-        self.Yahoo = YahooDataDownloader()
+        self.policy = FetchPolicy(requests_per_second)
+        self.pool = DownloadPool(workers, policy = self.policy)
+        self.scrapers = ScrapePool(scrape_workers)
+        self.responses = ResponseCache(os.path.join(self.store.root, RESPONSE_CACHE_FILENAME))
+        self.retries = RetryQueue(os.path.join(self.store.root, RETRY_QUEUE_FILENAME))
+        self.WSJ = WSJinternet(exchange, session = self.pool.session, cache = self.responses)
+        self.Yahoo = YahooDataDownloader(self.policy)
 
     def saveFinancials(self, tickers):
         # TODO savind financials should check that it is not overwriting data.
-        scraper = WSJscraper()
         errors = {}
+        tickers = [ticker.strip() for ticker in tickers]
         count = 0
-        for period in ['annual', 'interim']:
-            for ticker in tickers:
-                ticker = ticker.strip()
+        processed = []
+        with self.store.batched_commits(max_pending = 100):
+            for (ticker, period, pages), scraped, scrape_error in self.scrapeStatementPages(tickers, ['annual', 'interim']):
                 count += 1
                 if count % 100 == 0:
-                    print("Running {} out of {}...".format(count, len(tickers)))
-                statements = [StatementWebpage(ticker, 'income', period), 
-                              StatementWebpage(ticker, 'balance', period), 
-                              StatementWebpage(ticker, 'cashflow', period)]
+                    print("Running {} out of {}...".format(count, 2 * len(tickers)))
+                if scraped is None:
+                    scraped = {}
                 financials = Financials(ticker, period)
                 saving_financials = True
-                for statement in statements:
-                    try:
-                        statement.html = self.WSJ.load_page(ticker, statement.type, period)
-                        if saving_financials:
-                            try:
-                                financials.statements[statement.type] = scraper.getTables(statement.type, statement.html)
-                            except Exception:
-                                saving_financials = False
-                                errors[ticker] = "Scraper error - " + " ".join([period, statement.type])
-                            finally:
-                                self.store.save(statement)
-                    except Exception:
+                for sheet in STATEMENT_SHEETS:
+                    statement = StatementWebpage(ticker, sheet, period)
+                    statement.html, load_error = pages[sheet]
+                    if load_error is not None:
+                        saving_financials = False
                         errors[ticker] = "Page load error - " + " ".join([period, statement.type])
+                        continue
+                    if saving_financials:
+                        tables, error = scraped.get(sheet, (None, scrape_error))
+                        if error is None:
+                            financials.statements[statement.type] = tables
+                        else:
+                            saving_financials = False
+                            errors[ticker] = "Scraper error - " + " ".join([period, statement.type])
+                        self.store.save(statement)
                 if saving_financials:
                     self.store.save(financials)
+                    processed.append((ticker, period, pages))
+        self.markProcessed(processed)
+        self.retries.record("financials", tickers, errors)
         return errors
 
     def updateFinancials(self, tickers, period):
         if tickers is None:
             tickers = self.all_tickers()
-        
-        num_tickers = round(len(tickers) / 10.0, 0) * 10
 
-        for ticker in tickers:
-            
-            ticker_count = tickers.index(ticker)
-            if (ticker_count / num_tickers) % 0.1 == 0:
-                print("***", period.upper(), ": Downloading", ticker_count, "out of", len(tickers), "***")
+        errors = {}
+        count = 0
+        processed = []
+        with self.store.batched_commits(max_pending = 100):
+            for (ticker, period, pages), scraped, scrape_error in self.scrapeStatementPages(tickers, [period]):
+                count += 1
+                if count % 100 == 0:
+                    print("***", period.upper(), ": Downloaded", count, "out of", len(tickers), "***")
+
+                financials_template = Financials(ticker, period)
+                try:
+                    financials = self.store.load(financials_template)
+                except IOError:
+                    financials = financials_template
+
+                try:
+                    if scrape_error is not None:
+                        raise scrape_error
+                    new_financials = Financials(ticker, period)
+                    for sheet in STATEMENT_SHEETS:
+                        html, error = pages[sheet]
+                        if error is None:
+                            tables, error = scraped[sheet]
+                        if error is not None:
+                            raise error
+                        new_financials.statements[sheet] = tables
+                    financials.merge(new_financials)
+                except Exception as e:
+                    print(str(e) + " - problem with " + ticker)
+                    errors[ticker] = str(e)
+                else:
+                    self.store.save(financials)
+                    processed.append((ticker, period, pages))
+        self.markProcessed(processed)
+        self.retries.record("financials-" + period, tickers, errors)
+        return errors
 
-            financials_template = Financials(ticker, period)
-            try:
-                financials = self.store.load(financials_template)
-            except IOError:
-                financials = financials_template
+    def scrapeStatementPages(self, tickers, periods):
+        '''
+        Pipelines downloading and scraping. Pages are fetched on the download pool and
+        each ticker's set of pages is handed to the scrape pool as soon as it is complete.
+        Yields ((ticker, period, pages), scraped, error) as scraping finishes, where 
+        scraped is the result of scrape_pages.
+        '''
+        jobs = (((ticker, period, pages), (loaded_html(pages),)) 
+                for ticker, period, pages in self.fetchStatementPages(tickers, periods))
+        return self.scrapers.pipeline(scrape_pages, jobs)
 
-            try:
-                new_financials = self.WSJ.getFinancials(ticker, period)
-                financials.merge(new_financials)
-            except Exception as e:
-                print(str(e) + " - problem with " + ticker)
+    def fetchStatementPages(self, tickers, periods):
+        '''
+        Downloads every statement page for each ticker and period across the download pool.
+        Yields (ticker, period, pages) once all sheets for that ticker and period have
+        arrived, where pages maps each sheet to a tuple of (html, load_error).
+        Tickers whose pages are all unchanged since they were last processed are not
+        yielded, so they are neither scraped nor merged again.
+        '''
+        jobs = [(ticker, sheet, period) for period in periods 
+                for ticker in tickers for sheet in STATEMENT_SHEETS]
+        pending = {}
+        changed = {}
+        skipped = 0
+        for (ticker, sheet, period), page, error in self.pool.map(self.WSJ.fetch_page, jobs):
+            key = (ticker, period)
+            pages = pending.setdefault(key, {})
+            if error is None:
+                pages[sheet] = (page.content, None)
+                changed[key] = changed.get(key, False) or not page.unchanged
             else:
-                self.store.save(financials)
+                pages[sheet] = (None, error)
+                changed[key] = True
+            if len(pages) == len(STATEMENT_SHEETS):
+                pages = pending.pop(key)
+                if changed.pop(key):
+                    yield (ticker, period, pages)
+                else:
+                    skipped += 1
+        if skipped:
+            print("Skipped {} unchanged sets of statement pages".format(skipped))
+
+    def markProcessed(self, processed):
+        '''
+        Records the pages behind each saved (ticker, period, pages) as processed, once
+        the saves have been committed.
+        '''
+        for ticker, period, pages in processed:
+            for sheet, (html, error) in pages.items():
+                if html is not None:
+                    self.WSJ.page_processed(ticker, sheet, period, html)
 
     def updatePriceHistory(self, tickers = None, start = None):
+        '''
+        With no start date only the bars after each ticker's last stored date are 
+        downloaded, otherwise the full history from start is downloaded again.
+        '''
         if tickers is None:
             tickers = self.all_tickers()
 
-        for ticker in tickers:
-            price_history = PriceHistory(ticker)
-            try:
-                price_history.prices = self.Yahoo.priceHistory(ticker, start)
-            except Exception as e:
-                print(e.message + " - problem getting " + ticker)
-            else:
-                self.store.save(price_history)
+        downloader = PriceDownloader(Handler(os.path.dirname(self.store.data), self.store.exchange, self.policy))
+        if start is None:
+            errors = downloader.update(tickers)
+        else:
+            errors = downloader.download_and_save(tickers, start)
+        for ticker in errors:
+            print(errors[ticker] + " - problem getting " + ticker)
+        self.retries.record("prices", tickers, errors)
+        return errors
+
+    def retryFailures(self):
+        '''
+        Reruns each task with only the tickers which failed when it last ran, as kept
+        in the retry queue. Returns a dict of task -> errors.
+        '''
+        results = {}
+        for task in list(self.retries.tasks):
+            tickers = self.retries.pending(task)
+            print("Retrying {} failed tickers for {}...".format(len(tickers), task))
+            if task == "prices":
+                results[task] = self.updatePriceHistory(tickers)
+            elif task == "financials":
+                results[task] = self.saveFinancials(tickers)
+            elif task.startswith("financials-"):
+                results[task] = self.updateFinancials(tickers, task[len("financials-"):])
+        return results
 
     def priceHistory(self, ticker):
         price_history = PriceHistory(ticker)
@@ -103,12 +212,36 @@ class WebDownloader():
 
 
     def all_tickers(self):
-        return [ticker for ticker in os.listdir(self.store.data) if "." not in ticker]
+        return self.store.tickers()
+
+
+def loaded_html(pages):
+    return {sheet : pages[sheet][0] for sheet in pages if pages[sheet][1] is None}
+
+
+def scrape_pages(pages):
+    '''
+    Scrapes the tables from each sheet's html, working through the sheets in
+    STATEMENT_SHEETS order. Intended to run in a ScrapePool worker process.
+    Stops at the first sheet which fails, as the remainder would not be saved.
+    Returns a dict of sheet -> (tables, error).
+    '''
+    scraper = WSJscraper()
+    results = {}
+    for sheet in STATEMENT_SHEETS:
+        if sheet not in pages:
+            continue
+        try:
+            results[sheet] = (scraper.getTables(sheet, pages[sheet]), None)
+        except Exception as E:
+            results[sheet] = (None, E)
+            break
+    return results
 
 
 class WSJinternet():
 
-    def __init__(self, exchange = "ASX"):
+    def __init__(self, exchange = "ASX", session = None, cache = None):
         if exchange is "ASX":
             self.page_root = "http://quotes.wsj.com/AU/XASX/"
         elif exchange is "NYSE":
@@ -119,8 +252,12 @@ class WSJinternet():
                                 "balance" : "/financials/<period>/balance-sheet", 
                                 "cashflow" : "/financials/<period>/cash-flow"}
         self.scraper = WSJscraper()
-     
+        if session is None:
+            session = RateLimitedSession(FetchPolicy())
+        self.session = session
+        self.cache = cache
         
+
     def getFinancials(self, ticker, period):
         financials = Financials(ticker, period)
 
@@ -139,35 +276,49 @@ class WSJinternet():
         return  address.replace("<period>", period)
 
     def load_page(self, ticker, sheet, period):
-        try:
-            page = requests.get(self.get_address(ticker, sheet, period))
-        except requests.HTTPError:
-            print("Problem downloading: " + ticker + " " + sheet)
-        return page.content
+        return self.fetch_page(ticker, sheet, period).content
+
+    def fetch_page(self, ticker, sheet, period):
+        '''
+        Returns a CachedPage of (content, content_hash, unchanged) for the statement page.
+        With a ResponseCache the page is fetched conditionally, otherwise it is always
+        downloaded in full and reported as changed.
+        '''
+        address = self.get_address(ticker, sheet, period)
+        if self.cache is not None:
+            return self.cache.fetch(self.session, address)
+        page = self.session.get(address)
+        page.raise_for_status()
+        return CachedPage(page.content, None, False)
 
+    def page_processed(self, ticker, sheet, period, html):
+        if self.cache is not None:
+            self.cache.mark_processed(self.get_address(ticker, sheet, period), html)
 
-class WSJlocal(WSJinternet):
 
-    def __init__(self, exchange = "ASX"):
-        self.page_root = "D:\\Investing\\Data\\" + exchange + "\\"
-        self.statement_pages = {"income"    :   "\\Financials\\<period>\\<ticker>income.html", 
-                                "balance"   :   "\\Financials\\<period>\\<ticker>balance.html",
-                                "cashflow"   :   "\\Financials\\<period>\\<ticker>cashflow.html"}
+class WSJlocal(WSJinternet):
+    '''
+    Reads the statement pages archived by saveFinancials as StatementWebpage files, 
+    rather than downloading them.
+    '''
+    def __init__(self, exchange = "ASX", store = None):
+        if store is None:
+            store = Storage(exchange)
+        self.store = store
+        self.statement_pages = {sheet : None for sheet in STATEMENT_SHEETS}
         self.scraper = WSJscraper()
 
+    def page_path(self, ticker, sheet, period):
+        return self.store.find_file(StatementWebpage(ticker, sheet, period))
+
     def load_page(self, ticker, sheet, period):
-        location = self.page_root + ticker + self.statement_pages[sheet]
-        location = location.replace("<ticker>", ticker)
-        location = location.replace("<period>", period)
-        try:
-            with open(location, 'r') as file:
-                page = file.read()
-        except:
-            print("Problem loading: " + location)
-        return page
+        return self.store.load(StatementWebpage(ticker, sheet, period)).html
             
 
 class WSJscraper():
+    # Increase when a change to the scraping would alter the Financials produced, so 
+    # that download.rescrape rebuilds them from the archived pages.
+    version = 1
 
     def __init__(self):
         '''
@@ -215,18 +366,34 @@ class WSJscraper():
         return dict(zip(labels, values))
 
     def getTables(self, sheet, html):
+        '''
+        Pulls every table for the given sheet out of the html. The page is parsed
+        once and all of its statement tables are located from that one parse.
+        '''
         page = self.statements[sheet]
+        page_tables = self.page_tables(html)
         scraped_tables = {}
         for table in page:
             search_term = page[table]
-            scraped_tables[table] = self.read_statement_table(html, search_term)
+            scraped_tables[table] = self.find_statement_table(page_tables, search_term)
         return scraped_tables
 
+    def page_tables(self, html):
+        document = lxml.html.fromstring(html)
+        return [(table.text_content(), table) for table in document.iter("table")]
+
+    def find_statement_table(self, page_tables, contains):
+        for text, element in page_tables:
+            if re.search(contains, text):
+                table_html = lxml.html.tostring(element, encoding = "unicode")
+                table = pandas.read_html(io.StringIO(table_html), index_col = 0)[0]
+                return self.clean_statement_table(table)
+        raise MissingStatementEntryError("No tables found matching pattern " + repr(contains))
+
     def read_statement_table(self, html, contains):
-        try:
-            table = pandas.read_html(html, match = contains, index_col = 0)[0]
-        except ValueError as E:
-            raise MissingStatementEntryError(E.message)
+        return self.find_statement_table(self.page_tables(html), contains)
+
+    def clean_statement_table(self, table):
         headings = table.columns.tolist()
         # Delete empty columns after final year
         # First column after final year is trend column
@@ -246,8 +413,11 @@ class WSJscraper():
 
 class CMCscraper():
 
-    def __init__(self, store):
+    def __init__(self, store, policy = None):
         self.store = store
+        if policy is None:
+            policy = FetchPolicy()
+        self.policy = policy
         self.root_page = "https://www.cmcmarketsstockbroking.com.au"
         self.login_url = self.root_page + "/login.aspx"
         self.payload = {"logonAccount" : "markhocky", 
@@ -260,7 +430,7 @@ class CMCscraper():
     def loginSession(self):
         password = input("Enter password for " + self.payload["logonAccount"])
         self.payload["logonPassword"] = password
-        self.session = requests.Session()
+        self.session = RateLimitedSession(self.policy)
         self.session.post(self.login_url, data = self.payload)
 
     def researchPage(self, ticker):
@@ -268,14 +438,17 @@ class CMCscraper():
         return research_page
 
     def download_historicals(self, tickers):
+        errors = {}
         for ticker in tickers:
             try:
                 per_share, historical = self.historicalFigures(ticker)
-            except Exception:
+            except Exception as E:
                 print("No results for " + ticker)
+                errors[ticker] = str(E)
             else:
                 self.store.save(historical)
                 self.store.save(per_share)
+        return errors
 
 
     def historicalFigures(self, ticker):
@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .fetch_policy import FetchPolicy, RETRY_STATUSES
+
+
+class RateLimitedSession(requests.Session):
+    '''
+    A requests Session which makes every request under a FetchPolicy, so requests are
+    rate limited per host and transient failures (including RETRY_STATUSES responses)
+    are retried. A response with one of those statuses is raised as an HTTPError once
+    its retries are exhausted.
+    The underlying connection pool is shared between all threads using the session.
+    '''
+    def __init__(self, policy, pool_size = 10):
+        super().__init__()
+        self.policy = policy
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        return self.policy.call(urlparse(url).netloc, self.checked_request, method, url, *args, **kwargs)
+
+    def checked_request(self, method, url, *args, **kwargs):
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code in RETRY_STATUSES:
+            response.raise_for_status()
+        return response
+
+
+class DownloadPool():
+    '''
+    DownloadPool runs network bound jobs across a bounded number of worker threads.
+    All workers share one session under a FetchPolicy, so connections are pooled and
+    each host sees at most requests_per_second (unless a policy is given).
+    '''
+    pending_per_worker = 2
+
+    def __init__(self, workers = 8, requests_per_second = 4.0, policy = None):
+        self.workers = workers
+        if policy is None:
+            policy = FetchPolicy(requests_per_second)
+        self.policy = policy
+        self.session = RateLimitedSession(policy, pool_size = workers)
+
+    def map(self, function, jobs):
+        '''
+        Calls function(*job) for each job and yields (job, result, error) as each
+        completes. Exactly one of result and error will be None.
+        Results are yielded in completion order, not submission order.
+        Jobs are taken from the iterable as workers free up, with at most 
+        pending_per_worker jobs per worker in flight, so a long (or lazy) job list is 
+        never held as futures all at once. Jobs not yet started are cancelled if the 
+        caller stops early.
+        '''
+        max_pending = self.workers * self.pending_per_worker
+        jobs = iter(jobs)
+        executor = ThreadPoolExecutor(max_workers = self.workers)
+        try:
+            futures = {}
+            exhausted = False
+            while futures or not exhausted:
+                while not exhausted and len(futures) < max_pending:
+                    job = next(jobs, None)
+                    if job is None:
+                        exhausted = True
+                    else:
+                        futures[executor.submit(function, *job)] = job
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when = FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as E:
+                        yield (job, None, E)
+                    else:
+                        yield (job, result, None)
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+
+
+class ScrapePool():
+    '''
+    ScrapePool runs CPU bound parsing across worker processes, separately from
+    the threads doing the network fetching. The function given must be defined at
+    module level so that it can be sent to the workers.
+    '''
+    def __init__(self, workers = None):
+        self.workers = workers
+
+    def pipeline(self, function, jobs):
+        '''
+        jobs should yield (key, args) tuples, e.g. as pages arrive from a DownloadPool.
+        Each job is handed to the process pool as soon as it arrives so that parsing
+        proceeds while the producer keeps downloading.
+        Yields (key, result, error) in completion order.
+        '''
+        with ProcessPoolExecutor(max_workers = self.workers) as executor:
+            futures = {}
+            for key, args in jobs:
+                futures[executor.submit(function, *args)] = key
+                for future in [future for future in futures if future.done()]:
+                    yield self.collect(future, futures.pop(future))
+            for future in as_completed(futures):
+                yield self.collect(future, futures[future])
+
+    def collect(self, future, key):
+        try:
+            result = future.result()
+        except Exception as E:
+            return (key, None, E)
+        return (key, result, None)
@@ -5,47 +5,148 @@ Created on 6 Dec 2014
 '''
 
 import pandas_datareader
+from pandas_datareader import data as pd_data
+from pandas_datareader._utils import RemoteDataError
 import pickle
 import quandl
 import os
 import re
+import numpy as np
 import pandas as pd
 from datetime import date
 from pandas import DataFrame
 
-from formats.price_history import Instruments
+from formats.price_history import Instruments, PriceCube, PRICE_FIELDS, write_price_dataset, read_ticker_prices, read_price_dataset
+from formats.price_history import append_price_dataset, merge_prices, latest_price_date, adjustment_ratios
+from .adjustments import split_divisors, clean_adj_close
+from .pool import ScrapePool
+from .fetch_policy import FetchPolicy, is_transient
+from store.streaming import batched, prefetched
 
 
 DEFAULT_START_DATE = '2007-01-01'
+# Stored bars fetched again by Handler.update to check for restated history.
+OVERLAP_BARS = 5
+YAHOO_HOST = "query1.finance.yahoo.com"
+QUANDL_HOST = "www.quandl.com"
+
+
+def is_transient_yahoo(error):
+    # "No data fetched for symbol ..." is a delisted or unknown ticker, not an outage.
+    if isinstance(error, RemoteDataError):
+        return "No data fetched" not in str(error)
+    return is_transient(error)
+
+
+def is_transient_quandl(error):
+    transient = (quandl.errors.quandl_error.LimitExceededError, 
+                 quandl.errors.quandl_error.InternalServerError, 
+                 quandl.errors.quandl_error.ServiceUnavailableError)
+    return isinstance(error, transient) or is_transient(error)
+
 
 class Handler(object):
     '''
     Handler uses the Pandas data functionality to download data and handle local storage.
     '''
+    raw_fields = PRICE_FIELDS + ["Adj Close"]
+    adjusted_field = "Adj Close"
 
-    def __init__(self, location, exchange = "ASX"):
+    def __init__(self, location, exchange = "ASX", policy = None):
         '''
         Constructor
         '''
         self.location = location
         self.exchange = exchange
+        if policy is None:
+            policy = FetchPolicy()
+        self.policy = policy
 
         
     def get(self, ticker, start, end):
-        return pandas_datareader.get_data_yahoo(ticker + ".AX", start, end)
+        return self.policy.call(YAHOO_HOST, pandas_datareader.get_data_yahoo, ticker + ".AX", start, end, 
+                                transient = is_transient_yahoo)
 
 
     def build_path(self, ticker):
         return os.path.join(self.location, self.exchange, ticker, ticker + "prices.pkl")
+
+    def dataset_path(self):
+        return os.path.join(self.location, self.exchange, "prices.parquet")
     
     def save(self, instrument, ticker):
-        with open(self.build_path(ticker), "wb") as file:
-            pickle.dump(instrument, file)
+        write_price_dataset(self.dataset_path(), {ticker : instrument})
         
     def load(self, ticker, start = None, end = None):
-        with open(self.build_path(ticker), "rb") as file:
-            instrument = pd.read_pickle(file)
-        return self.adjust(instrument[start:end])
+        return self.adjust(self.load_raw(ticker, start, end))
+
+    def load_raw(self, ticker, start = None, end = None):
+        try:
+            instrument = read_ticker_prices(self.dataset_path(), ticker, start, end)
+        except FileNotFoundError:
+            # Not yet migrated from the pickle store.
+            with open(self.build_path(ticker), "rb") as file:
+                instrument = pd.read_pickle(file)
+            instrument = instrument[start:end]
+        return instrument
+
+    def load_raw_prices(self, tickers, start = None, end = None):
+        '''
+        Reads raw prices for many tickers with one scan of the price dataset, falling
+        back to load_raw for tickers not found there. Returns (price_data, errors), 
+        dicts of ticker -> DataFrame and ticker -> error message.
+        '''
+        price_data, errors = {}, {}
+        try:
+            prices = read_price_dataset(self.dataset_path(), tickers, start, end)
+        except FileNotFoundError:
+            prices = None
+        if prices is not None:
+            for ticker, ticker_prices in prices.groupby("ticker", sort = False):
+                price_data[ticker] = ticker_prices.drop(columns = "ticker").set_index("Date")
+        for ticker in tickers:
+            if ticker in price_data:
+                continue
+            try:
+                price_data[ticker] = self.load_raw(ticker, start, end)
+            except Exception as E:
+                errors[ticker] = str(E)
+        return ({ticker : price_data[ticker] for ticker in tickers if ticker in price_data}, errors)
+
+    def update(self, ticker, end = None):
+        '''
+        Downloads only the bars after the last stored date and appends them to the stored prices.
+        The last OVERLAP_BARS stored bars are fetched again as an overlap check. If the source has 
+        restated them (a new split or dividend has changed the adjusted values by the same ratio 
+        on every bar) the changed columns of the stored history are rescaled to match locally, 
+        rather than being downloaded again.
+        Returns the number of new bars saved.
+        '''
+        if end is None:
+            end = date.today()
+        dataset_path = self.dataset_path()
+        try:
+            last_date = latest_price_date(dataset_path, ticker)
+        except FileNotFoundError:
+            if not os.path.exists(self.build_path(ticker)):
+                data = self.get(ticker, DEFAULT_START_DATE, end)
+                self.save(data, ticker)
+                return len(data)
+            # Not yet migrated from the pickle store.
+            write_price_dataset(dataset_path, {ticker : pd.read_pickle(self.build_path(ticker))})
+            last_date = latest_price_date(dataset_path, ticker)
+        stored_bars = read_ticker_prices(dataset_path, ticker, last_date - pd.Timedelta(days = 31), last_date)
+        stored_bars = stored_bars.tail(OVERLAP_BARS)
+        fetched = self.get(ticker, stored_bars.index[0], end)
+        new_bars = fetched[fetched.index > last_date]
+        ratios = adjustment_ratios(stored_bars, fetched, adjusted_column = self.adjusted_field)
+        if ratios.empty:
+            append_price_dataset(dataset_path, ticker, new_bars)
+        else:
+            history = read_ticker_prices(dataset_path, ticker)
+            history[ratios.index] = history[ratios.index] * ratios
+            write_price_dataset(dataset_path, {ticker : merge_prices(history, new_bars)})
+        return len(new_bars)
 
     def adjust(self, instrument):
         instrument = self.clean_adj_close(instrument)
@@ -59,66 +160,126 @@ class Handler(object):
         return adjusted_data
 
     
+    def adjust_cube(self, raw):
+        '''
+        Batched equivalent of adjust for a PriceCube of raw_fields, correcting split 
+        errors and adjusting every ticker in one set of array operations. Dates on which
+        a ticker has no bar are skipped when finding its split errors, so each ticker
+        is adjusted the same as by adjust.
+        '''
+        values = raw.as_array()
+        field = raw.fields.index
+        close = values[:, :, field("Close")]
+        adj_close = values[:, :, field("Adj Close")] / split_divisors(values[:, :, field("Adj Close")], close)
+        adjust_ratios = adj_close / close
+        adjusted = np.empty(values.shape[:2] + (len(PRICE_FIELDS),), dtype = np.float32)
+        for i, price_field in enumerate(PRICE_FIELDS):
+            if price_field == "Volume":
+                adjusted[:, :, i] = values[:, :, field("Volume")]
+            else:
+                adjusted[:, :, i] = values[:, :, field(price_field)] * adjust_ratios
+        return PriceCube(adjusted, raw.tickers, raw.dates, PRICE_FIELDS)
+    
     def clean_adj_close(self, instrument):
         '''
         Takes a dataframe [OHLCV & Adj Close] for a ticker
         Tries to find any erroneous Adj Close values caused by stock splits.
         '''
-        adj_ratios = instrument["Adj Close"] / instrument["Adj Close"].shift(1)
-        close_ratios = instrument["Close"] / instrument["Close"].shift(1)
-        limit = 3.0
-        possible_errors = adj_ratios > limit
-        while any(possible_errors):
+        return clean_adj_close(instrument)
+
+    def download_market(self, tickers, start = DEFAULT_START_DATE, end = None):
+        '''
+        Downloads and adjusts prices for tickers without saving them, returning them as 
+        Instruments. Tickers which fail are recorded in the Instruments' errors.
+        '''
+        if end is None:
+            end = date.today()
+        price_data, errors = {}, {}
+        for ticker in tickers:
             try:
-                start = adj_ratios[possible_errors].index[0]
-                ix = 0
-                end = adj_ratios[adj_ratios < (1 / limit)].index[ix]
-                while end < start:
-                    ix += 1
-                    end = adj_ratios[adj_ratios < (1 / limit)].index[ix]
-            except IndexError:
-                possible_errors[start] = False
+                price_data[ticker] = self.get(ticker, start, end)
+            except Exception as E:
+                errors[ticker] = str(E)
+        return self.as_instruments(self.adjust_cube(PriceCube.from_frames(price_data, self.raw_fields)), errors)
+
+    def load_market(self, tickers, start = DEFAULT_START_DATE, end = None):
+        return self.load_instruments(tickers, start, end)
+
+    def load_instruments(self, tickers, start = DEFAULT_START_DATE, end = None, workers = None, chunk_size = 100):
+        '''
+        Loads and adjusts the stored prices for tickers into one Instruments cube.
+        Chunks of chunk_size tickers are read and adjusted across a pool of worker 
+        processes (one per core by default, workers = 1 loads in this process), and 
+        each chunk is copied into a cube preallocated over the union of their dates.
+        Each ticker is adjusted over its own bars only, so the result does not depend
+        on which tickers share a chunk.
+        Tickers which fail to load are left out and recorded in the Instruments' errors.
+        '''
+        chunks = [tickers[i:(i + chunk_size)] for i in range(0, len(tickers), chunk_size)]
+        if workers == 1 or len(chunks) <= 1:
+            results = (load_adjusted_chunk(self, chunk, start, end) for chunk in chunks)
+        else:
+            jobs = ((i, (self, chunk, start, end)) for i, chunk in enumerate(chunks))
+            results = self.collect_chunks(ScrapePool(workers).pipeline(load_adjusted_chunk, jobs), chunks)
+        loaded, errors = [], {}
+        for cube, chunk_errors in results:
+            errors.update(chunk_errors)
+            if cube is not None:
+                loaded.append(cube)
+        return self.as_instruments(PriceCube.concatenate(loaded, PRICE_FIELDS), errors)
+
+    def iter_instruments(self, tickers, start = DEFAULT_START_DATE, end = None, batch_size = 100, prefetch = 1):
+        '''
+        Streaming version of load_instruments, yielding Instruments for batch_size 
+        tickers at a time. The next batches are read and adjusted on a background 
+        thread while the current one is in use.
+        '''
+        load_batch = lambda batch: load_adjusted_chunk(self, batch, start, end)
+        for cube, errors in prefetched(batched(tickers, batch_size), load_batch, prefetch):
+            if cube is None:
+                self.report_errors(errors)
             else:
-                if (1 / limit) < close_ratios[end] < limit:
-                    # Indicates Close is out of sync with Adj Close
-                    divisor = round(adj_ratios[start])
-                    instrument["Adj Close"][start:(end - DateOffset(1))] = instrument["Adj Close"][start:(end - DateOffset(1))] / divisor
-                    adj_ratios = instrument["Adj Close"] / instrument["Adj Close"].shift(1)
-                    possible_errors = adj_ratios > limit
-                else:
-                    # may be a genuine spike in the data
-                    possible_errors[start] = False
-        return instrument
+                yield self.as_instruments(cube, errors)
 
-    def download_market(self, tickers):
-        market = Market(tickers, self.start, self.end)
-        market.exchange = self.exchange
-        for ticker in tickers:
-            raw = self.get(ticker, self.start, self.end)
-            market[ticker] = self.adjust(raw)
-        return market
-
-    def load_market(self, tickers):
-        market = Market(tickers, self.start, self.end)
-        market.exchange = self.exchange
-        for ticker in self.tickers:
-            market[ticker] = self.load(ticker, self.start, self.end)
-        return market
-
-    def load_instruments(self, tickers, start = DEFAULT_START_DATE, end = None):
-        price_data = {}
-        for ticker in tickers:
-            price_data[ticker] = self.load(ticker, start, end)
+    def collect_chunks(self, completed, chunks):
+        by_chunk = {}
+        for i, result, error in completed:
+            if error is not None:
+                result = (None, {ticker : str(error) for ticker in chunks[i]})
+            by_chunk[i] = result
+        return [by_chunk[i] for i in sorted(by_chunk)]
+
+    def report_errors(self, errors):
+        for ticker in errors:
+            print(errors[ticker] + " - problem loading " + ticker)
+
+    def as_instruments(self, cube, errors):
+        self.report_errors(errors)
         instruments = Instruments(self.exchange)
-        instruments.data = pd.Panel.from_dict(price_data)
+        instruments.data = cube
+        instruments.errors = errors
+        instruments.set_dates()
         return instruments
 
-    
+
+def load_adjusted_chunk(handler, tickers, start, end):
+    '''
+    Reads and adjusts prices for a chunk of tickers, returning (cube, errors) where
+    errors maps each ticker which could not be read to its error.
+    '''
+    price_data, errors = handler.load_raw_prices(tickers, start, end)
+    if not price_data:
+        return (None, errors)
+    return (handler.adjust_cube(PriceCube.from_frames(price_data, handler.raw_fields)), errors)
+
 
 class quandlAPI(Handler):
 
-    def __init__(self, location = r"D:\Investing\Data", exchange = "NYSE"):
-        super().__init__(location, exchange)
+    raw_fields = ["Adj. Open", "Adj. High", "Adj. Low", "Adj. Close", "Adj. Volume"]
+    adjusted_field = "Adj. Close"
+
+    def __init__(self, location = r"D:\Investing\Data", exchange = "NYSE", policy = None):
+        super().__init__(location, exchange, policy)
         with open(r'D:\Investing\Data\_keys\quandl.pkl', 'rb') as quandl_key:
             quandl.ApiConfig.api_key = pickle.load(quandl_key)
 
@@ -127,13 +288,17 @@ class quandlAPI(Handler):
             start = start.strftime("%Y-%m-%d")
         if isinstance(end, date):
             end = end.strftime("%Y-%m-%d")
-        return quandl.get("WIKI/" + ticker, start_date = start, end_date = end)
+        return self.policy.call(QUANDL_HOST, quandl.get, "WIKI/" + ticker, start_date = start, end_date = end, 
+                                transient = is_transient_quandl)
 
     def adjust(self, instrument):
         instrument_adj = instrument[["Adj. Open", "Adj. High", "Adj. Low", "Adj. Close", "Adj. Volume"]]
         instrument_adj.columns = ["Open", "High", "Low", "Close", "Volume"]
         return instrument_adj
 
+    def adjust_cube(self, raw):
+        return PriceCube(raw.as_array(), raw.tickers, raw.dates, PRICE_FIELDS)
+
 
 
 class PriceDownloader():
@@ -145,6 +310,16 @@ class PriceDownloader():
     def download_and_save(self, tickers, start = DEFAULT_START_DATE, end = None):
         if end is None:
             end = date.today()
+        return self.for_each(tickers, lambda ticker: self.handler.save(self.handler.get(ticker, start, end), ticker))
+
+    def update(self, tickers, end = None):
+        '''
+        Incremental version of download_and_save, only the bars after each ticker's 
+        last stored date are downloaded.
+        '''
+        return self.for_each(tickers, lambda ticker: self.handler.update(ticker, end))
+
+    def for_each(self, tickers, action):
         count = 0
         errors = {}
         for ticker in tickers:
@@ -155,8 +330,7 @@ class PriceDownloader():
             if re.search("[/^/.]", ticker) is not None:
                 continue
             try:
-                data = self.handler.get(ticker, start, end)
-                self.handler.save(data, ticker)
+                action(ticker)
             except quandl.errors.quandl_error.NotFoundError:
                 errors[ticker] = "Not found in quandl DB"
             except Exception as E:
@@ -169,15 +343,21 @@ class YahooDataDownloader():
     '''
     Uses the Pandas data functionality to download data.
     '''
+    def __init__(self, policy = None):
+        if policy is None:
+            policy = FetchPolicy()
+        self.policy = policy
+
     def priceHistory(self, ticker, start = None, end = None):
         if start is None:
-            start = datetime.date(2010, 1, 1)
+            start = date(2010, 1, 1)
         if end is None:
-            end = datetime.date.today()
-        return pd_data.get_data_yahoo(ticker + ".AX", start, end)
+            end = date.today()
+        return self.policy.call(YAHOO_HOST, pd_data.get_data_yahoo, ticker + ".AX", start, end, 
+                                transient = is_transient_yahoo)
 
     def currentPrice(self, ticker):
         ticker = ticker + ".AX"
-        quote = pd_data.get_quote_yahoo(ticker)
+        quote = self.policy.call(YAHOO_HOST, pd_data.get_quote_yahoo, ticker, transient = is_transient_yahoo)
         return quote["last"][ticker]
 
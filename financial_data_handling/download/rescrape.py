@@ -0,0 +1,149 @@
+'''
+Rebuilds Financials from the statement pages archived as StatementWebpage files, e.g.
+after a change to WSJscraper, without downloading anything.
+Tickers are scraped across a ScrapePool and the rescraped periods are merged into
+the stored Financials, so periods added since the pages were archived (e.g. by
+updateFinancials, which does not archive its pages) are kept. A manifest in the
+exchange's data folder records the page files (mtime and size) and the
+WSJscraper.version each Financials was last built from, and tickers for which
+neither has changed are skipped.
+Run from the financial_data_handling folder, e.g.
+    python -m download.rescrape ASX D:\\Investing\\
+    python -m download.rescrape ASX D:\\Investing\\ --force
+'''
+import os
+import sys
+import json
+import time
+import pandas
+
+from formats import temporary_path, replace_file
+from formats.fundamentals import Financials, StatementWebpage
+from store.file_system import Storage
+from store.cache import file_signature
+from .financials import STATEMENT_SHEETS, WSJscraper
+from .pool import ScrapePool
+
+
+MANIFEST_FILENAME = "rescrape_manifest.json"
+
+
+def manifest_path(store):
+    return os.path.join(store.data, MANIFEST_FILENAME)
+
+
+def load_manifest(store):
+    try:
+        with open(manifest_path(store), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(store, manifest):
+    file_path = manifest_path(store)
+    temp_path = temporary_path(file_path)
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file)
+    replace_file(temp_path, file_path)
+
+
+def archive_pages(store, ticker, period):
+    '''
+    The paths of the ticker's archived pages by sheet, or None if any are missing.
+    '''
+    pages = {sheet : store.find_file(StatementWebpage(ticker, sheet, period)) for sheet in STATEMENT_SHEETS}
+    if not all(os.path.exists(path) for path in pages.values()):
+        return None
+    return pages
+
+
+def archive_entry(pages):
+    '''
+    The manifest entry for a set of archived pages, or None if any have gone.
+    '''
+    signatures = []
+    for sheet in STATEMENT_SHEETS:
+        signature = file_signature(pages[sheet])
+        if signature is None:
+            return None
+        signatures.append(list(signature))
+    return {"pages" : signatures, "scraper" : WSJscraper.version}
+
+
+def rescrape_financials(ticker, period, pages):
+    '''
+    Scrapes the archived pages (paths by sheet) into Financials. Intended to run in
+    a ScrapePool worker process. Returns (financials, seconds taken).
+    '''
+    start = time.time()
+    scraper = WSJscraper()
+    financials = Financials(ticker, period)
+    for sheet in STATEMENT_SHEETS:
+        html = StatementWebpage(ticker, sheet, period).load_from(pages[sheet]).html
+        financials.statements[sheet] = scraper.getTables(sheet, html)
+    return (financials, time.time() - start)
+
+
+def rescrape(store, tickers = None, periods = ("annual", "interim"), workers = None, force = False):
+    '''
+    Rescrapes each ticker and period with archived pages and merges the result into
+    its stored Financials, skipping those unchanged since the last rescrape unless 
+    force is True.
+    Returns a DataFrame indexed by ticker and period of the seconds taken and any
+    error, for each ticker which was scraped.
+    '''
+    if tickers is None:
+        tickers = store.tickers()
+    manifest = load_manifest(store)
+    jobs = []
+    skipped = 0
+    for ticker in tickers:
+        for period in periods:
+            pages = archive_pages(store, ticker, period)
+            if pages is None:
+                continue
+            entry = archive_entry(pages)
+            key = ticker + "/" + period
+            if not force and manifest.get(key) == entry:
+                skipped += 1
+                continue
+            jobs.append(((key, ticker, period, entry), (ticker, period, pages)))
+
+    print("Rescraping {} (skipping {} unchanged)...".format(len(jobs), skipped))
+    start = time.time()
+    rebuilt = {}
+    report = []
+    with store.batched_commits(max_pending = 100):
+        for (key, ticker, period, entry), result, error in ScrapePool(workers).pipeline(rescrape_financials, iter(jobs)):
+            if error is not None:
+                report.append((ticker, period, None, "{}: {}".format(type(error).__name__, error)))
+                continue
+            rescraped, seconds = result
+            try:
+                financials = store.load(Financials(ticker, period))
+            except IOError:
+                financials = Financials(ticker, period)
+            financials.merge(rescraped)
+            store.save(financials)
+            rebuilt[key] = entry
+            report.append((ticker, period, seconds, None))
+            if len(report) % 100 == 0:
+                print("Rescraped {} out of {}...".format(len(report), len(jobs)))
+    manifest.update(rebuilt)
+    save_manifest(store, manifest)
+
+    elapsed = time.time() - start
+    report = pandas.DataFrame(report, columns = ["ticker", "period", "seconds", "error"])
+    report = report.set_index(["ticker", "period"]).sort_index()
+    print("Rebuilt {} Financials in {:.1f}s ({:.1f} per second), {} errors".format(
+        len(rebuilt), elapsed, len(rebuilt) / elapsed if elapsed else 0.0, report["error"].notna().sum()))
+    return report
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    store = Storage(args[0] if len(args) > 0 else "ASX", args[1] if len(args) > 1 else "D:\\Investing\\")
+    report = rescrape(store, force = "--force" in sys.argv)
+    for (ticker, period), error in report["error"].dropna().items():
+        print(error + " - problem with " + ticker + " " + period)
@@ -0,0 +1,94 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import zlib
+from collections import namedtuple
+
+
+RESPONSE_CACHE_FILENAME = "responses.sqlite"
+
+RESPONSE_SCHEMA = '''CREATE TABLE IF NOT EXISTS response (
+                         url TEXT PRIMARY KEY,
+                         etag TEXT,
+                         last_modified TEXT,
+                         content_hash TEXT,
+                         processed_hash TEXT,
+                         body BLOB)'''
+
+
+CachedPage = namedtuple("CachedPage", ["content", "content_hash", "unchanged"])
+
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+class ResponseCache():
+    '''
+    ResponseCache keeps the last response for each url in a SQLite database, with its
+    ETag and Last-Modified headers, so pages can be re-fetched with a conditional GET.
+    A 304 Not Modified response is answered from the stored body.
+    Each url also records the content hash which was last processed successfully (see
+    mark_processed). A fetched page is unchanged when its content hash matches that,
+    i.e. there is nothing new to scrape whether or not the server honoured the
+    conditional request.
+    '''
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        with self.connection:
+            self.connection.execute(RESPONSE_SCHEMA)
+        self.requests = 0
+        self.not_modified = 0
+
+    def lookup(self, url):
+        with self.lock:
+            return self.connection.execute('''SELECT etag, last_modified, content_hash, processed_hash, body
+                                              FROM response WHERE url = ?''', (url,)).fetchone()
+
+    def fetch(self, session, url):
+        '''
+        Gets url through the session, conditionally if a response is already held.
+        Returns a CachedPage of (content, content_hash, unchanged).
+        Raises requests.HTTPError for an error status.
+        '''
+        stored = self.lookup(url)
+        headers = {}
+        if stored is not None:
+            etag, last_modified = stored[0], stored[1]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        response = session.get(url, headers = headers)
+        self.requests += 1
+        if response.status_code == 304 and stored is not None:
+            self.not_modified += 1
+            content = zlib.decompress(stored[4])
+            return CachedPage(content, stored[2], stored[2] == stored[3])
+        response.raise_for_status()
+        content = response.content
+        digest = content_hash(content)
+        processed = stored[3] if stored is not None else None
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)",
+                                    (url, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                     digest, processed, zlib.compress(content)))
+        return CachedPage(content, digest, digest == processed)
+
+    def mark_processed(self, url, content):
+        '''
+        Records content as processed for url, so the same content is reported as
+        unchanged by later fetches.
+        '''
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE response SET processed_hash = ? WHERE url = ?",
+                                    (content_hash(content), url))
+
+    def close(self):
+        self.connection.close()
@@ -1,10 +1,137 @@
+import os
+import json
+import uuid
+import pandas
+import pyarrow
+import pyarrow.parquet as pq
+
+
+TEMPORARY_PREFIX = ".tmp-"
+MIXED_COLUMNS_KEY = b"mixed_columns"
+
+
+def temporary_path(file_path):
+    '''
+    A unique path in the same folder as file_path to write to before renaming into place. 
+    The filename (and so its extension) is kept at the end, e.g. .tmp-<id>-AAAannual.pkl
+    '''
+    folder, filename = os.path.split(file_path)
+    return os.path.join(folder, TEMPORARY_PREFIX + uuid.uuid4().hex + "-" + filename)
+
+
+def sync_file(file_path):
+    with open(file_path, "rb") as file:
+        os.fsync(file.fileno())
+
+
+def sync_folder(folder):
+    '''
+    Makes renames within folder durable. Not supported (or needed) on Windows.
+    '''
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    descriptor = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def replace_file(temp_path, file_path, sync = True):
+    '''
+    Moves a fully written temp_path over file_path with an atomic rename, so readers see
+    either the old or the new file, never a partial one. With sync the data is flushed
+    to disk before the rename and the rename itself is flushed after.
+    '''
+    if sync:
+        sync_file(temp_path)
+    os.replace(temp_path, file_path)
+    if sync:
+        sync_folder(os.path.dirname(file_path) or ".")
+
+
+def remove_temporary(temp_path):
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+def write_table(table, file_path):
+    '''
+    Saves a table as Parquet. Object columns holding a mix of types, e.g. numbers 
+    alongside '-' placeholders read in from Excel, are stored as strings with missing 
+    values left missing, and listed in the file's metadata so that read_table can
+    restore their numbers.
+    '''
+    table = table.copy()
+    mixed = []
+    for column in table.columns[(table.dtypes == object).values]:
+        values = table[column]
+        if values.dropna().map(type).nunique() > 1:
+            table[column] = values.where(values.isnull(), values.astype(str))
+            mixed.append(str(column))
+    if table.index.dtype == object and table.index.map(type).nunique() > 1:
+        table.index = table.index.astype(str)
+    arrow_table = pyarrow.Table.from_pandas(table)
+    metadata = dict(arrow_table.schema.metadata or {})
+    metadata[MIXED_COLUMNS_KEY] = json.dumps(mixed).encode()
+    pq.write_table(arrow_table.replace_schema_metadata(metadata), file_path)
+
+
+def read_table(file_path, **excel_args):
+    '''
+    Reads a table saved by write_table, or an Excel file if given an .xlsx path.
+    Entries of mixed columns which are numbers are converted back, leaving the rest 
+    (e.g. '-' placeholders) as they were written.
+    '''
+    if file_path.endswith(".xlsx"):
+        return pandas.read_excel(file_path, **excel_args)
+    arrow_table = pq.read_table(file_path)
+    table = arrow_table.to_pandas()
+    mixed = json.loads((arrow_table.schema.metadata or {}).get(MIXED_COLUMNS_KEY, b"[]"))
+    for column in mixed:
+        values = table[column].astype(object)
+        numbers = pandas.to_numeric(values, errors = "coerce")
+        table[column] = numbers.astype(object).where(numbers.notnull(), values)
+    return table
 
 
 class StorageResource():
+    '''
+    Storage.save has save_to write to a temporary file, which is then renamed over the 
+    resource's file. Resources which make their own writes atomic (e.g. datasets of
+    many files) set saves_atomically and are given their final path instead.
+    '''
+    saves_atomically = False
 
     def select_folder(self, store):
         raise NotImplementedError
 
+    def legacy_path(self, store):
+        '''
+        Location of the resource in an older storage format, tried by Storage.load
+        when the resource cannot be found at its current location.
+        '''
+        return None
+
+    def source_path(self, file_path):
+        '''
+        The file or folder holding this resource's data within file_path. Storage checks
+        this for changes, e.g. a single ticker's partition within a shared dataset.
+        '''
+        return file_path
+
+    def cache_key(self):
+        '''
+        Anything besides the file path which distinguishes what this resource loads.
+        '''
+        return ()
+
+    def catalog_entry(self):
+        '''
+        The (kind, label, date) under which Storage catalogs this resource's file.
+        '''
+        return (type(self).__name__, None, None)
+
     def filename(self):
         raise NotImplementedError
 
@@ -1,42 +1,222 @@
 import requests
 import os
 import shutil
+import numpy
 import pandas
 import datetime
 import pickle
+import json
+import ast
+import pyarrow
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from collections.abc import MutableMapping
 from pandas_datareader import data as pd_data
 from pandas_datareader import base as pd_base
 from bs4 import BeautifulSoup
 
-from formats import StorageResource
+from formats import StorageResource, write_table, read_table, temporary_path, replace_file, remove_temporary
+
+
+FACT_COLUMNS = ["ticker", "period", "statement", "table", "line_item", "date", "value"]
+PANEL_COLUMNS = ["ticker", "period_end", "statement", "table", "line_item", "value"]
+
+
+def period_dates(labels, period, errors = "raise"):
+    '''
+    Converts statement column labels to period end dates. Annual labels are years 
+    (e.g. '2016') and are dated at the end of that year, interim labels are full 
+    dates (e.g. '31-Dec-2016'). With errors = "coerce" labels in any other format 
+    (e.g. 'TTM') become NaT rather than raising.
+    '''
+    labels = pandas.Index(labels).astype(str)
+    if period == "annual":
+        return pandas.to_datetime(labels, format = "%Y", errors = errors) + pandas.offsets.YearEnd(0)
+    return pandas.to_datetime(labels, format = "%d-%b-%Y", errors = errors)
+
+
+def period_keys(labels, period):
+    '''
+    Keys for matching statement columns: the period end date for labels period_dates
+    understands, and the label itself for any it does not (e.g. a label in a format
+    the scraper has not seen before).
+    '''
+    labels = pandas.Index(labels).astype(str)
+    dates = period_dates(labels, period, errors = "coerce")
+    return pandas.Index(numpy.where(dates.isna(), labels, dates.strftime("%Y-%m-%d")))
+
+
+def numeric_values(values):
+    '''
+    Converts scraped statement values to floats, e.g. '1,234' -> 1234.0 and 
+    '(56)' -> -56.0. Entries which are not numbers (such as '-') become NaN.
+    '''
+    values = pandas.Series(values).astype(str)
+    values = values.str.replace(",", "", regex = False).str.replace("%", "", regex = False)
+    values = values.str.replace("(", "-", regex = False).str.replace(")", "", regex = False)
+    return pandas.to_numeric(values, errors = "coerce").to_numpy(dtype = float)
+
+
+def label_dates(labels, periods, errors = "raise"):
+    '''
+    Vectorized period_dates for labels from a mix of periods. Each distinct label 
+    is only parsed once.
+    '''
+    labels = numpy.asarray(labels, dtype = object)
+    periods = numpy.asarray(periods, dtype = object)
+    positions, dates = [], []
+    for period in pandas.unique(periods):
+        selected = numpy.flatnonzero(periods == period)
+        codes, distinct = pandas.factorize(labels[selected])
+        positions.append(selected)
+        dates.append(period_dates(distinct, period, errors)[codes])
+    order = numpy.argsort(numpy.concatenate(positions), kind = "stable")
+    return dates[0].append(dates[1:])[order]
+
+
+def financials_panel(financials, errors = None):
+    '''
+    Builds one long format DataFrame (with FACT_COLUMNS) from any number of Financials, 
+    e.g. a whole exchange. All tables are stacked by column position and converted 
+    together, and column labels are parsed to period end dates once for the panel.
+    Columns whose label is not a period end date (e.g. 'TTM') are left out, as in
+    Financials.merge they are only matched by label. If an errors dict is given, 
+    each ticker with columns left out is recorded in it with their labels.
+    '''
+    keys, tables, labels = [], [], []
+    for statement in financials:
+        for sheet in statement.statements:
+            for table_name, table in statement.statements[sheet].items():
+                keys.append((statement.ticker, statement.period, sheet, table_name))
+                tables.append(table.set_axis(range(table.shape[1]), axis = 1))
+                labels.append(list(map(str, table.columns)))
+    if not keys:
+        return pandas.DataFrame(columns = FACT_COLUMNS)
+    stacked = pandas.concat(tables)
+    widths = numpy.array([len(table_labels) for table_labels in labels])
+    table_rows = numpy.repeat(numpy.arange(len(tables)), [len(table) for table in tables])
+    label_grid = numpy.array([table_labels + [None] * (stacked.shape[1] - len(table_labels)) 
+                              for table_labels in labels], dtype = object)
+    present = numpy.arange(stacked.shape[1]) < widths[table_rows][:, None]
+    panel = pandas.DataFrame(keys, columns = FACT_COLUMNS[:4])
+    panel = panel.iloc[numpy.repeat(table_rows, widths[table_rows])].reset_index(drop = True)
+    panel["line_item"] = numpy.repeat(stacked.index.astype(str).values, widths[table_rows])
+    column_labels = label_grid[table_rows][present]
+    panel["date"] = label_dates(column_labels, panel["period"].values, errors = "coerce")
+    panel["value"] = stacked.apply(numeric_values).values[present]
+    undated = panel["date"].isna().values
+    if errors is not None and undated.any():
+        left_out = pandas.DataFrame({"ticker" : panel["ticker"].values[undated], 
+                                     "label" : column_labels[undated]}).drop_duplicates()
+        for ticker, ticker_labels in left_out.groupby("ticker")["label"]:
+            errors[ticker] = "Unrecognised period labels left out: " + ", ".join(sorted(ticker_labels))
+    return panel[~undated].reset_index(drop = True)
+
+
+def merge_panels(stored, downloaded):
+    '''
+    Merges downloaded facts into stored facts, both long format panels. As with 
+    Financials.merge, a period present in a downloaded table replaces that period 
+    of the stored table entirely, and stored periods not downloaded are kept. 
+    Tables missing from either side are taken from the other.
+    '''
+    columns = ["ticker", "period", "statement", "table", "date"]
+    replaced = pandas.MultiIndex.from_frame(stored[columns]).isin(
+        pandas.MultiIndex.from_frame(downloaded[columns]))
+    merged = pandas.concat([downloaded, stored[~replaced]], ignore_index = True)
+    return merged.sort_values(["ticker", "period"], kind = "stable", ignore_index = True)
+
+
+def merge_financials(stored, downloaded):
+    '''
+    Merges a batch of downloaded Financials into the stored Financials for the same 
+    tickers in one pass, returning the merged exchange-wide long format panel.
+    '''
+    return merge_panels(financials_panel(stored), financials_panel(downloaded))
+
+
+class LazyTables(MutableMapping):
+    '''
+    The tables of one statement, as stored by Financials. Each table is kept as its 
+    pickled bytes until first accessed, so loading a Financials only deserializes the 
+    tables actually used. Tables not yet accessed are saved again without unpickling.
+    '''
+    def __init__(self, pickled = None):
+        self.pickled = dict(pickled or {})
+        self.tables = {}
+
+    @classmethod
+    def from_tables(cls, tables):
+        lazy_tables = cls()
+        lazy_tables.tables.update(tables)
+        return lazy_tables
+
+    def __getitem__(self, name):
+        if name not in self.tables:
+            self.tables[name] = pickle.loads(self.pickled.pop(name))
+        return self.tables[name]
+
+    def __setitem__(self, name, table):
+        self.pickled.pop(name, None)
+        self.tables[name] = table
+
+    def __delitem__(self, name):
+        if name in self.tables:
+            del self.tables[name]
+        else:
+            del self.pickled[name]
 
-class Financials(StorageResource):
+    def __iter__(self):
+        return iter(list(self.tables) + list(self.pickled))
+
+    def __len__(self):
+        return len(self.tables) + len(self.pickled)
+
+    def __contains__(self, name):
+        return name in self.tables or name in self.pickled
+
+    def to_pickled(self):
+        pickled = dict(self.pickled)
+        for name, table in self.tables.items():
+            pickled[name] = pickle.dumps(table, protocol = pickle.HIGHEST_PROTOCOL)
+        return pickled
 
+
+class Financials(StorageResource):
+    '''
+    Financials holds the statement tables (e.g. income, balance, cashflow) scraped for 
+    a ticker and period. Each table is pickled separately within the file and only 
+    unpickled when first used, e.g. reading income does not load the cashflow tables.
+    Files in the older format, which pickled all statements together, still load.
+    '''
     def __init__(self, ticker, period):
         self.ticker = ticker
         self.period = period.lower()
         self.statements = {}
 
     def merge(self, other):
+        '''
+        Merges other's tables into these. Periods in other replace the matching periods
+        (compared as dates, or as labels where a label is not a recognised date) of each 
+        table, and tables only in other are added.
+        '''
         self.confirm_match(other.ticker, other.period)
         for sheet in other.statements:
-            try:
-                existing_sheet = self.statements[sheet]
-            except KeyError:
+            if sheet not in self.statements:
                 self.statements[sheet] = other.statements[sheet]
-            else:
-                new_sheet = other.statements[sheet]
-                for table in new_sheet:
-                    existing_table = existing_sheet[table]
-                    new_table = new_sheet[table]
-                    joined_table = self.merge_columns(existing_table, new_table)
-                    self.statements[sheet][table] = joined_table
+                continue
+            existing_sheet = self.statements[sheet]
+            new_sheet = other.statements[sheet]
+            for table in new_sheet:
+                if table in existing_sheet:
+                    existing_sheet[table] = self.merge_columns(existing_sheet[table], new_sheet[table])
+                else:
+                    existing_sheet[table] = new_sheet[table]
 
     def merge_columns(self, existing, new):
-        existing_years = existing.columns.tolist()
-        new_years = new.columns.tolist()
-        append_years = [year not in new_years for year in existing_years]
-        return pandas.concat([new, existing.iloc[:, append_years]], axis = 1)
+        new_keys = period_keys(new.columns, self.period)
+        append_periods = ~period_keys(existing.columns, self.period).isin(new_keys)
+        return pandas.concat([new, existing.loc[:, append_periods]], axis = 1)
 
     def confirm_match(self, ticker, period):
         if ticker != self.ticker or period != self.period:
@@ -45,6 +225,9 @@ class Financials(StorageResource):
     def select_folder(self, store):
         return store.financials(self)
 
+    def catalog_entry(self):
+        return ("Financials", self.period, None)
+
     def filename(self):
         return self.ticker + self.period + ".pkl"
  
@@ -59,15 +242,24 @@ class Financials(StorageResource):
         return self
 
     def to_dict(self):
+        statements = {}
+        for sheet, tables in self.statements.items():
+            if not isinstance(tables, LazyTables):
+                tables = LazyTables.from_tables(tables)
+            statements[sheet] = tables.to_pickled()
         return {"ticker" : self.ticker,
                 "period" : self.period, 
-                "statements" : self.statements}
+                "pickled_tables" : True,
+                "statements" : statements}
 
     def from_dict(self, dictionary):
         ticker = dictionary["ticker"]
         period = dictionary["period"].lower()
         self.confirm_match(ticker, period)
-        self.statements = dictionary["statements"]
+        if dictionary.get("pickled_tables", False):
+            self.statements = {sheet : LazyTables(tables) for sheet, tables in dictionary["statements"].items()}
+        else:
+            self.statements = dictionary["statements"]
 
     @property
     def income(self):
@@ -106,6 +298,110 @@ class Financials(StorageResource):
     def num_columns(self):
         return len(self.income.columns)
 
+    def as_long_format(self):
+        '''
+        Returns every statement table as one long DataFrame with a row per line item and
+        period: ticker, period, statement, table, line_item, date (period end), value.
+        '''
+        return financials_panel([self])
+
+
+class FundamentalsPanel(StorageResource):
+    '''
+    Every stored statement value for an exchange and period (annual or interim) in one
+    Parquet file, one row per ticker, period end, statement table and line item. Rows
+    are sorted by statement and line item so that queries for a few line items only
+    read the row groups holding them. Setting any of the filters restricts what is 
+    read on load; they are applied within the Parquet reader.
+    sources records the signature of each ticker's Financials file when it was added,
+    so that Storage.update_fundamentals only reloads the files which have changed.
+    '''
+    row_group_size = 65536
+    saves_atomically = True
+
+    def __init__(self, exchange, period, tickers = None, statements = None, 
+                 line_items = None, start = None, end = None):
+        self.exchange = exchange
+        self.period = period.lower()
+        self.filters = {"ticker" : tickers, "statement" : statements, "line_item" : line_items}
+        self.start = start
+        self.end = end
+        self.data = pandas.DataFrame(columns = PANEL_COLUMNS)
+        self.sources = {}
+
+    def select_folder(self, store):
+        return store.data
+
+    def catalog_entry(self):
+        return ("FundamentalsPanel", self.period, None)
+
+    def filename(self):
+        return "fundamentals_" + self.period + ".parquet"
+
+    def cache_key(self):
+        filters = tuple(None if values is None else tuple(values) for values in self.filters.values())
+        return filters + (str(self.start), str(self.end))
+
+    def condition(self):
+        condition = None
+        for column, values in self.filters.items():
+            if values is not None:
+                condition = self.combine(condition, ds.field(column).isin(list(values)))
+        if self.start is not None:
+            condition = self.combine(condition, ds.field("period_end") >= pandas.Timestamp(self.start).to_pydatetime())
+        if self.end is not None:
+            condition = self.combine(condition, ds.field("period_end") <= pandas.Timestamp(self.end).to_pydatetime())
+        return condition
+
+    def combine(self, condition, new_condition):
+        return new_condition if condition is None else condition & new_condition
+
+    def load_from(self, file_path):
+        if not os.path.exists(file_path):
+            raise FileNotFoundError("No fundamentals panel at " + file_path)
+        self.load_sources(file_path)
+        table = ds.dataset(file_path, format = "parquet").to_table(filter = self.condition())
+        self.data = table.to_pandas()
+        return self
+
+    def load_sources(self, file_path):
+        '''
+        Reads just the sources from the file's metadata, without loading any rows.
+        '''
+        metadata = pq.read_schema(file_path).metadata or {}
+        self.sources = json.loads(metadata.get(b"sources", b"{}"))
+        return self
+
+    def save_to(self, file_path):
+        data = self.data[PANEL_COLUMNS].sort_values(["statement", "line_item", "ticker", "period_end"], 
+                                                   ignore_index = True)
+        table = pyarrow.Table.from_pandas(data, preserve_index = False)
+        table = table.replace_schema_metadata({b"sources" : json.dumps(self.sources).encode()})
+        temp_path = temporary_path(file_path)
+        try:
+            pq.write_table(table, temp_path, row_group_size = self.row_group_size)
+            replace_file(temp_path, file_path)
+        finally:
+            remove_temporary(temp_path)
+
+    def replace_tickers(self, tickers, facts):
+        '''
+        Replaces all rows for tickers with facts (long format, as from financials_panel).
+        '''
+        facts = facts[facts["value"].notnull()].rename(columns = {"date" : "period_end"})
+        kept = self.data[~self.data["ticker"].isin(list(tickers))]
+        if kept.empty:
+            self.data = facts[PANEL_COLUMNS].reset_index(drop = True)
+        else:
+            self.data = pandas.concat([kept, facts[PANEL_COLUMNS]], ignore_index = True)
+
+    def as_wide_values(self, line_item):
+        '''
+        One line item as a table of period ends x tickers.
+        '''
+        selected = self.data[self.data["line_item"] == line_item]
+        return selected.pivot_table(index = "period_end", columns = "ticker", values = "value", aggfunc = "last")
+
 
 class StatementWebpage(StorageResource):
 
@@ -116,7 +412,7 @@ class StatementWebpage(StorageResource):
         self.html = None
 
     def select_folder(self, store):
-        if self.period is "annual":
+        if self.period == "annual":
             return store.annual_financials(self)
         else:
             return store.interim_financials(self)
@@ -124,14 +420,32 @@ class StatementWebpage(StorageResource):
     def filename(self):
         return self.ticker + self.type + ".html"
 
+    def catalog_entry(self):
+        return ("StatementWebpage", self.type, None)
+
     def load_from(self, file_path):
-        with open(file_path, 'r') as file:
-            self.html = file.read()
+        with open(file_path, 'r', encoding = "utf-8", errors = "replace") as file:
+            self.html = page_text(file.read())
         return self
 
     def save_to(self, file_path):
-        with open(file_path, 'w') as file:
-            file.write(str(self.html))
+        with open(file_path, 'w', encoding = "utf-8") as file:
+            file.write(page_text(self.html))
+
+
+def page_text(html):
+    '''
+    Returns html as text. Downloaded pages arrive as bytes, which were previously 
+    saved as their repr (i.e. "b'<html>...'"); such files are recovered here.
+    '''
+    if isinstance(html, str) and html.startswith(("b'", 'b"')):
+        try:
+            html = ast.literal_eval(html)
+        except (ValueError, SyntaxError):
+            pass
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", errors = "replace")
+    return str(html)
 
 
 class Valuations(StorageResource):
@@ -150,14 +464,26 @@ class Valuations(StorageResource):
     def select_folder(self, store):
         return store.valuation_summary(self)
 
+    def catalog_entry(self):
+        return ("Valuations", self.type, self.date)
+
     def filename(self):
-        return "Valuation" + self.type + self.date + ".xlsx"
+        return "Valuation" + self.type + self.date + ".parquet"
+
+    def legacy_path(self, store):
+        return self.excel_path(store)
+
+    def excel_path(self, store):
+        return os.path.join(self.select_folder(store), "Valuation" + self.type + self.date + ".xlsx")
 
     def load_from(self, file_path):
-        self.data = pandas.read_excel(file_path, index_col = 0)
+        self.data = read_table(file_path, index_col = 0)
         return self
 
     def save_to(self, file_path):
+        write_table(self.data, file_path)
+
+    def to_excel(self, file_path):
         self.data.to_excel(file_path)
 
 
@@ -170,23 +496,64 @@ class StackedValuations(Valuations):
     dataframe with a column for each ticker.
     """
     
+    def load_from(self, file_path):
+        super().load_from(file_path)
+        self.build_index()
+        return self
+
+    def build_index(self):
+        '''
+        Sorts the rows by ticker then date once, so that each ticker's rows are one
+        contiguous slice found by binary search. Wide tables computed from the data are
+        cached until the index is next built.
+        '''
+        tickers = self.data["ticker"].to_numpy(dtype = str)
+        order = numpy.lexsort((self.data.index.values, tickers))
+        self.sorted_data = self.data.iloc[order]
+        self.sorted_tickers = tickers[order]
+        self.indexed_data = self.data
+        self.wide_cache = {}
+
+    def check_index(self):
+        if getattr(self, "indexed_data", None) is not self.data:
+            self.build_index()
+
     def __getitem__(self, key):
-        return self.data[self.data.ticker == key][self.data.columns[1:]]
+        self.check_index()
+        start = self.sorted_tickers.searchsorted(key, side = "left")
+        end = self.sorted_tickers.searchsorted(key, side = "right")
+        return self.sorted_data.iloc[start:end][self.data.columns[1:]]
 
     @property
     def types(self):
         return self.data.columns[1:].tolist()
 
-    def as_wide_values(self, type = None, index = None):
+    def as_wide_values(self, type = None, index = None, cached = True):
         if type is None or type not in self.types:
             raise TypeError("A type is required. Select one of: {0}".format(", ".join(self.types)))
-        df = self.data.copy()
-        df['date'] = df.index
-        df = df.pivot(index = 'date', columns = 'ticker', values = type)
-        df = df.fillna(method = 'ffill')
+        return self.wide_tables(index, cached)[type]
+
+    def wide_tables(self, index = None, cached = True):
+        '''
+        Returns a dict of type -> table of dates x tickers for every type, forward filled
+        (and reindexed to index if given). All types are pivoted, filled and reindexed
+        together in one pass. With cached, results are kept for each index requested.
+        '''
+        self.check_index()
+        key = None if index is None else (len(index), index[0], index[-1]) if len(index) else ()
+        if cached and key in self.wide_cache:
+            cached_index, tables = self.wide_cache[key]
+            if index is None or cached_index.equals(index):
+                return tables
+        stacked = self.sorted_data.set_index("ticker", append = True)
+        stacked = stacked[~stacked.index.duplicated(keep = "last")]
+        wide = stacked.unstack("ticker").sort_index().ffill()
         if index is not None:
-            df = df.reindex(index, method = 'ffill')
-        return df
+            wide = wide.reindex(index, method = "ffill")
+        tables = {type : wide[type].rename_axis("date").rename_axis("ticker", axis = 1) for type in self.types}
+        if cached:
+            self.wide_cache[key] = (index, tables)
+        return tables
 
 
 class AnalysisSummary(StorageResource):
@@ -1,7 +1,8 @@
 
+import os
 import pandas
 
-from formats import StorageResource
+from formats import StorageResource, write_table, read_table
 from store.db_wrapper import Company
 
 
@@ -49,14 +50,25 @@ class ListedCompanies(StorageResource):
         return store.exchange_information(self)
 
     def filename(self):
-        return self.exchange + "ListedCompanies.xlsx"
+        return self.exchange + "ListedCompanies.parquet"
+
+    def legacy_path(self, store):
+        return self.excel_path(store)
+
+    def excel_path(self, store):
+        return os.path.join(self.select_folder(store), self.exchange + "ListedCompanies.xlsx")
 
     def load_from(self, file_path):
-        table = pandas.read_excel(file_path, header = 0)
-        table.index = table.pop(self.index_heading)
+        table = read_table(file_path, header = 0)
+        if self.index_heading in table.columns:
+            table.index = table.pop(self.index_heading)
         self.table = table
+        return self
 
     def save_to(self, file_path):
+        write_table(self.table, file_path)
+
+    def to_excel(self, file_path):
         self.table.to_excel(file_path, sheet_name = "Stock table")
 
     def get_header(self):
@@ -72,6 +84,22 @@ class ListedCompanies(StorageResource):
             record_list.append(self.company_record(ticker))
         return record_list
 
+    def as_company_frame(self):
+        '''
+        Returns the table as rows matching the company db table, one per ticker.
+        '''
+        if self.sector_heading:
+            sector = self.table[self.sector_heading].values
+        else:
+            sector = None
+        companies = pandas.DataFrame({"ticker" : self.table.index.astype(str), 
+                                      "exchange" : self.exchange, 
+                                      "name" : self.table[self.name_heading].values, 
+                                      "sector" : sector, 
+                                      "industry_group" : self.table[self.industry_heading].values})
+        companies = companies.drop_duplicates("ticker", keep = "last")
+        return companies.astype(object).where(companies.notnull(), None)
+
     def company_record(self, ticker):
         name = self.table.loc[ticker, self.name_heading]
         if self.sector_heading:
@@ -0,0 +1,145 @@
+import os
+import re
+import hashlib
+import numpy as np
+import pandas
+
+from formats import StorageResource
+from formats.price_history import PriceCube
+
+
+# Time allowed after a period end before its figures are assumed to be public,
+# in line with the ASX deadlines for annual and half year reports.
+REPORTING_LAGS = {"annual" : pandas.Timedelta(days = 90),
+                  "interim" : pandas.Timedelta(days = 75)}
+
+
+def availability_dates(period_ends, period, lag = None):
+    '''
+    The dates from which statement figures can be used, i.e. their period end plus
+    the reporting lag for the period (or the lag given, as a Timedelta or days).
+    '''
+    if lag is None:
+        lag = REPORTING_LAGS[period]
+    elif not isinstance(lag, pandas.Timedelta):
+        lag = pandas.Timedelta(days = lag)
+    return pandas.DatetimeIndex(period_ends) + lag
+
+
+def asof_values(ticker_codes, item_codes, available, values, dates, shape):
+    '''
+    Builds a tickers x dates x items array holding, at each date, the latest value
+    available on or before that date (NaN before the first). Each fact is placed at
+    the first date on or after it becomes available with one searchsorted over the
+    whole universe, then carried forward along the dates axis.
+    Facts should be ordered so that, of those becoming available on the same date,
+    the one to use comes last.
+    '''
+    rows = np.asarray(dates.searchsorted(available, side = "left"))
+    in_range = rows < len(dates)
+    placed = pandas.DataFrame({"ticker" : ticker_codes[in_range], "row" : rows[in_range],
+                               "item" : item_codes[in_range], "value" : values[in_range]})
+    placed = placed.drop_duplicates(["ticker", "row", "item"], keep = "last")
+    ticker, row, item = placed["ticker"].values, placed["row"].values, placed["item"].values
+    sparse = np.full(shape, np.nan, dtype = np.float32)
+    sparse[ticker, row, item] = placed["value"].values
+    latest = np.full(shape, -1, dtype = np.int32)
+    latest[ticker, row, item] = row
+    latest = np.maximum.accumulate(latest, axis = 1)
+    aligned = np.take_along_axis(sparse, np.maximum(latest, 0), axis = 1)
+    aligned[latest < 0] = np.nan
+    return aligned
+
+
+class AlignedFundamentals(StorageResource):
+    '''
+    Statement line items lined up with a daily date index for a universe of tickers,
+    so that each date only sees figures which were available at the time. The data
+    is a PriceCube of tickers x dates x line items; use data.field(line_item) for a
+    dates x tickers table.
+    Built cubes are cached in the workspace, named by a hash of what was asked for 
+    (line items, tickers, lag and dates) and a hash of the fundamentals panel file's 
+    signature, so a cached cube is only used while its inputs are unchanged. Once a
+    cube is rebuilt from a changed panel, the cubes built from earlier panels are 
+    removed (see remove_superseded).
+    '''
+    saves_atomically = True
+
+    def __init__(self, exchange, period, line_items, dates, tickers = None, lag = None, source = None):
+        self.exchange = exchange
+        self.period = period.lower()
+        self.line_items = list(line_items)
+        self.dates = pandas.DatetimeIndex(dates)
+        self.tickers = None if tickers is None else list(tickers)
+        self.lag = lag
+        self.source = source
+        self.data = None
+
+    def select_folder(self, store):
+        return os.path.join(store.workspace(self), "aligned")
+
+    def catalog_entry(self):
+        return ("AlignedFundamentals", self.period, None)
+
+    def filename(self):
+        return "_".join([self.exchange.lower(), self.period, self.request_key(), self.source_key()]) + ".npy"
+
+    def request_key(self):
+        digest = hashlib.sha1()
+        digest.update(repr((self.line_items, self.tickers, str(self.lag))).encode())
+        digest.update(self.dates.asi8.tobytes())
+        return digest.hexdigest()[:16]
+
+    def source_key(self):
+        return hashlib.sha1(repr(self.source).encode()).hexdigest()[:8]
+
+    def superseded_files(self, folder):
+        '''
+        Cubes in folder for the exchange and period built from other panels, which
+        are no longer looked up.
+        '''
+        label = "_".join([self.exchange.lower(), self.period]) + "_"
+        cube_name = re.compile(re.escape(label) + r"[0-9a-f]{16}_[0-9a-f]{8}\.npy$")
+        current = "_" + self.source_key() + ".npy"
+        return [os.path.join(folder, filename) for filename in os.listdir(folder) 
+                if cube_name.match(filename) and not filename.endswith(current)]
+
+    def remove_superseded(self, folder):
+        '''
+        Deletes the superseded_files, returning their paths.
+        '''
+        superseded = self.superseded_files(folder)
+        for file_path in superseded:
+            PriceCube.delete(file_path)
+        return superseded
+
+    def load_from(self, file_path):
+        self.data = PriceCube.open(file_path)
+        return self
+
+    def save_to(self, file_path):
+        self.data.save(file_path)
+
+    def build(self, facts):
+        '''
+        facts is a long table with ticker, period_end, line_item and value columns, as
+        from Storage.query_fundamentals. Where several periods become available on the
+        same date the latest period is used.
+        '''
+        facts = facts[facts["line_item"].isin(self.line_items)]
+        tickers = self.tickers
+        if tickers is None:
+            tickers = sorted(facts["ticker"].unique())
+        ticker_codes = pandas.Index(tickers).get_indexer(facts["ticker"])
+        facts = facts[ticker_codes >= 0]
+        ticker_codes = ticker_codes[ticker_codes >= 0]
+        available = availability_dates(facts["period_end"], self.period, self.lag)
+        order = np.lexsort((facts["period_end"].values, available.values))
+        values = asof_values(ticker_codes[order],
+                             pandas.Index(self.line_items).get_indexer(facts["line_item"])[order],
+                             available[order],
+                             facts["value"].values[order],
+                             self.dates,
+                             (len(tickers), len(self.dates), len(self.line_items)))
+        self.data = PriceCube(values, tickers, self.dates, self.line_items)
+        return self
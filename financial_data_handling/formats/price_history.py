@@ -1,57 +1,473 @@
 
+import os
+import shutil
+import uuid
+import numpy as np
 import pandas
+import pyarrow
+import pyarrow.dataset as ds
 
-from formats import StorageResource
+from formats import StorageResource, temporary_path, replace_file, remove_temporary, sync_file
+
+
+PRICE_FIELDS = ["Open", "High", "Low", "Close", "Volume"]
+CUBE_FILES = ["values", "tickers", "dates", "fields"]
+STAGING_FOLDER = ".staging"
+PRICE_PARTITIONING = ds.partitioning(pyarrow.schema([("ticker", pyarrow.string()), ("year", pyarrow.int32())]), flavor = "hive")
+
+
+def write_price_dataset(dataset_path, frames, full = True):
+    '''
+    Writes price frames (dict of ticker -> DataFrame indexed by date) into the Parquet
+    dataset at dataset_path, partitioned by ticker and year:
+        <dataset_path>/ticker=<ticker>/year=<year>/part-0.parquet
+    Each ticker/year partition written to is replaced. With full, each frame is the
+    ticker's whole history and its other year partitions are removed; otherwise (as 
+    for append_price_dataset) they are left untouched.
+    Partitions are written to a staging folder first and then moved into place with
+    an atomic rename, so readers never see a partially written partition. Staging
+    folders are made within <dataset_path>/.staging, so that writing does not change
+    the dataset folder itself, which Catalog watches for added tickers.
+    '''
+    long_frames = []
+    for ticker, frame in frames.items():
+        long_frame = frame.rename_axis("Date").reset_index()
+        long_frame["ticker"] = ticker
+        long_frame["year"] = long_frame["Date"].dt.year.astype("int32")
+        long_frames.append(long_frame)
+    table = pyarrow.Table.from_pandas(pandas.concat(long_frames, ignore_index = True), preserve_index = False)
+    staging_path = os.path.join(dataset_path, STAGING_FOLDER, uuid.uuid4().hex)
+    try:
+        ds.write_dataset(table, staging_path, format = "parquet", partitioning = PRICE_PARTITIONING, 
+                         basename_template = "part-{i}.parquet")
+        for staged_folder, _, staged_files in os.walk(staging_path):
+            if not staged_files:
+                continue
+            partition = os.path.join(dataset_path, os.path.relpath(staged_folder, staging_path))
+            os.makedirs(partition, exist_ok = True)
+            stale_files = set(os.listdir(partition)) - set(staged_files)
+            for filename in staged_files:
+                sync_file(os.path.join(staged_folder, filename))
+                os.replace(os.path.join(staged_folder, filename), os.path.join(partition, filename))
+            for filename in stale_files:
+                os.remove(os.path.join(partition, filename))
+    finally:
+        shutil.rmtree(staging_path, ignore_errors = True)
+    if full:
+        for ticker, frame in frames.items():
+            remove_stale_years(dataset_path, ticker, set(frame.index.year))
+
+
+def remove_stale_years(dataset_path, ticker, years):
+    '''
+    Removes the ticker's year partitions other than years.
+    '''
+    ticker_folder = os.path.join(dataset_path, "ticker=" + ticker)
+    if not os.path.isdir(ticker_folder):
+        return
+    for year_folder in os.listdir(ticker_folder):
+        if int(year_folder.split("=", 1)[1]) not in years:
+            shutil.rmtree(os.path.join(ticker_folder, year_folder))
+
+
+def append_price_dataset(dataset_path, ticker, new_data):
+    '''
+    Appends new_data for ticker to the dataset. Only the year partitions which the new
+    rows fall in are read, merged and rewritten; where dates overlap new_data wins.
+    '''
+    if new_data.empty:
+        return
+    first_year = str(new_data.index.min().year)
+    try:
+        existing = read_ticker_prices(dataset_path, ticker, start = first_year)
+    except FileNotFoundError:
+        existing = new_data.iloc[0:0]
+    write_price_dataset(dataset_path, {ticker : merge_prices(existing, new_data)}, full = False)
+
+
+def merge_prices(existing, new_data):
+    combined = pandas.concat([existing[~existing.index.isin(new_data.index)], new_data])
+    return combined.sort_index()
+
+
+def latest_price_date(dataset_path, ticker):
+    '''
+    Returns the last date stored for ticker, reading only the Date column of its latest year.
+    Raises FileNotFoundError if nothing is stored for the ticker.
+    '''
+    ticker_folder = os.path.join(dataset_path, "ticker=" + ticker)
+    if not os.path.isdir(ticker_folder):
+        raise FileNotFoundError("No prices stored for " + ticker)
+    years = [int(folder.split("=", 1)[1]) for folder in os.listdir(ticker_folder)]
+    dates = read_price_dataset(dataset_path, [ticker], start = str(max(years)), columns = ["Date"])["Date"]
+    return dates.max()
+
+
+def confirmed_ratio(stored, fetched, tolerance = 1e-4):
+    '''
+    The ratio of fetched to stored values for one column over the overlapping bars, if
+    it is the same on every bar (within tolerance) and differs from 1, otherwise None.
+    '''
+    ratios = (fetched / stored).astype(float)
+    ratios = ratios[np.isfinite(ratios) & (ratios != 0)]
+    if ratios.empty:
+        return None
+    ratio = ratios.median()
+    if ((ratios / ratio - 1).abs() > tolerance).any() or abs(ratio - 1) <= tolerance:
+        return None
+    return ratio
+
+
+def adjustment_ratios(stored, fetched, tolerance = 1e-4, confirm_bars = 3, adjusted_column = "Adj Close"):
+    '''
+    Compares the stored and freshly fetched values for the same bars. Sources such as
+    Yahoo restate history when a split or dividend occurs, which shows up as a constant
+    ratio between fetched and stored values. A restatement is only accepted when the
+    adjusted_column ratio is the same across at least confirm_bars overlapping bars (or
+    all the stored bars, if fewer), so a single revised bar does not rescale history.
+    Other columns are included only where they have also changed by a constant ratio, 
+    as Close and Volume do for a split; for a dividend only adjusted_column changes.
+    Returns the ratio for each column to rescale (empty if history is unchanged).
+    '''
+    overlap = stored.index.intersection(fetched.index)
+    columns = stored.columns.intersection(fetched.columns)
+    no_change = pandas.Series(dtype = float)
+    if len(overlap) < min(confirm_bars, len(stored.index)) or adjusted_column not in columns:
+        return no_change
+    stored = stored.loc[overlap, columns]
+    fetched = fetched.loc[overlap, columns]
+    adjusted_ratio = confirmed_ratio(stored[adjusted_column], fetched[adjusted_column], tolerance)
+    if adjusted_ratio is None:
+        return no_change
+    ratios = {adjusted_column : adjusted_ratio}
+    for column in columns.drop(adjusted_column):
+        ratio = confirmed_ratio(stored[column], fetched[column], tolerance)
+        if ratio is not None:
+            ratios[column] = ratio
+    return pandas.Series(ratios, dtype = float)
+
+
+def price_dataset_tickers(dataset_path):
+    return [folder.split("=", 1)[1] for folder in os.listdir(dataset_path) if folder.startswith("ticker=")]
+
+
+def price_dataset_files(dataset_path, tickers, start = None, end = None):
+    '''
+    Lists the parquet files needed for the given tickers and date range. Partitions are
+    pruned here from the folder names so that the rest of the dataset is never scanned.
+    '''
+    files = []
+    for ticker in tickers:
+        ticker_folder = os.path.join(dataset_path, "ticker=" + ticker)
+        if not os.path.isdir(ticker_folder):
+            continue
+        for year_folder in os.listdir(ticker_folder):
+            year = int(year_folder.split("=", 1)[1])
+            if start is not None and year < start.year:
+                continue
+            if end is not None and year > end.year:
+                continue
+            folder = os.path.join(ticker_folder, year_folder)
+            files.extend(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".parquet"))
+    return files
+
+
+def read_price_dataset(dataset_path, tickers = None, start = None, end = None, columns = None):
+    '''
+    Reads price data from the Parquet dataset at dataset_path as a long table with a Date
+    and ticker column. Only the partitions for the requested tickers and years are opened,
+    and within those only the requested columns and the row groups overlapping [start, end].
+    Raises FileNotFoundError if there is no data for any of the tickers.
+    '''
+    if not os.path.isdir(dataset_path):
+        raise FileNotFoundError("No price dataset at " + dataset_path)
+    if tickers is None:
+        tickers = price_dataset_tickers(dataset_path)
+    start = None if start is None else pandas.Timestamp(start)
+    end = None if end is None else pandas.Timestamp(end)
+    files = price_dataset_files(dataset_path, tickers, start, end)
+    if not files:
+        raise FileNotFoundError("No prices stored for " + ", ".join(tickers))
+    dataset = ds.dataset(files, format = "parquet", partitioning = PRICE_PARTITIONING, partition_base_dir = dataset_path)
+    condition = None
+    if start is not None:
+        condition = ds.field("Date") >= start.to_pydatetime()
+    if end is not None:
+        before_end = ds.field("Date") <= end.to_pydatetime()
+        condition = before_end if condition is None else condition & before_end
+    if columns is not None:
+        columns = ["Date", "ticker"] + [column for column in columns if column not in ["Date", "ticker"]]
+    table = dataset.to_table(columns = columns, filter = condition)
+    frame = table.to_pandas()
+    if "year" in frame.columns:
+        del frame["year"]
+    return frame.sort_values(["ticker", "Date"], kind = "stable")
+
+
+def read_ticker_prices(dataset_path, ticker, start = None, end = None, columns = None):
+    frame = read_price_dataset(dataset_path, [ticker], start, end, columns)
+    del frame["ticker"]
+    return frame.set_index("Date")
+
+
+class PriceCube():
+    '''
+    PriceCube holds prices for many tickers as a dense float32 array of 
+    tickers x dates x fields. When opened from disk the array is memory mapped,
+    so nothing is read until it is touched. Ticker and date selections share the
+    underlying array rather than copying it.
+    The cube is saved as .values.npy, .tickers.npy, .dates.npy and .fields.npy files
+    under a versioned stem, with the .npy file named by the resource pointing to them.
+    '''
+    def __init__(self, values, tickers, dates, fields, positions = None, date_slice = None):
+        self.values = values
+        self.all_tickers = list(tickers)
+        self.all_dates = pandas.DatetimeIndex(dates)
+        self.fields = list(fields)
+        if positions is None:
+            positions = slice(0, len(self.all_tickers))
+        if date_slice is None:
+            date_slice = slice(0, len(self.all_dates))
+        self.positions = positions
+        self.date_slice = date_slice
+        self._lookup = None
+
+    @classmethod
+    def from_frames(cls, frames, fields = PRICE_FIELDS):
+        '''
+        Builds an in memory cube from a dict of ticker -> DataFrame, aligned on 
+        the union of all their dates.
+        '''
+        tickers = list(frames)
+        dates = pandas.DatetimeIndex([])
+        for frame in frames.values():
+            dates = dates.union(frame.index)
+        values = np.full((len(tickers), len(dates), len(fields)), np.nan, dtype = np.float32)
+        for i, ticker in enumerate(tickers):
+            frame = frames[ticker]
+            values[i, dates.get_indexer(frame.index), :] = frame[fields].to_numpy(dtype = np.float32)
+        return cls(values, tickers, dates, fields)
+
+    @classmethod
+    def concatenate(cls, cubes, fields = PRICE_FIELDS):
+        '''
+        Combines cubes holding different tickers into one cube, preallocated over 
+        the union of their dates, copying each cube's values straight into place.
+        '''
+        dates = pandas.DatetimeIndex([])
+        for cube in cubes:
+            dates = dates.union(cube.dates)
+        tickers = [ticker for cube in cubes for ticker in cube.tickers]
+        values = np.full((len(tickers), len(dates), len(fields)), np.nan, dtype = np.float32)
+        row = 0
+        for cube in cubes:
+            cube_values = cube.as_array()
+            values[row:(row + len(cube_values)), dates.get_indexer(cube.dates), :] = cube_values
+            row += len(cube_values)
+        return cls(values, tickers, dates, fields)
+
+    @classmethod
+    def open(cls, file_path):
+        stem = cls.current_stem(file_path)
+        values = np.load(stem + ".values.npy", mmap_mode = "r")
+        tickers = np.load(stem + ".tickers.npy").tolist()
+        dates = np.load(stem + ".dates.npy")
+        fields = np.load(stem + ".fields.npy").tolist()
+        return cls(values, tickers, dates, fields)
+
+    @staticmethod
+    def sidecar_base(file_path):
+        return os.path.splitext(file_path)[0]
+
+    @classmethod
+    def current_stem(cls, file_path):
+        '''
+        The stem of the files last saved for the cube at file_path, which holds their
+        version.
+        '''
+        return cls.sidecar_base(file_path) + "." + str(np.load(file_path)[()])
+
+    def save(self, file_path):
+        '''
+        Writes the values and each axis under a new versioned stem, i.e. 
+        <name>.<version>.values.npy etc., then switches to them by renaming a pointer 
+        holding the version into file_path. Readers therefore always see values and 
+        axes which were saved together. Files of superseded versions are then removed.
+        '''
+        version = uuid.uuid4().hex[:12]
+        stem = self.sidecar_base(file_path) + "." + version
+        tickers = self.tickers
+        dates = self.dates
+        axes = {"tickers" : np.array(tickers, dtype = str), 
+                "dates" : dates.values.astype("datetime64[ns]"), 
+                "fields" : np.array(self.fields, dtype = str)}
+        temp_path = temporary_path(file_path)
+        try:
+            for name, axis in axes.items():
+                with open(stem + "." + name + ".npy", "wb") as file:
+                    np.save(file, axis)
+                sync_file(stem + "." + name + ".npy")
+            values = np.lib.format.open_memmap(stem + ".values.npy", mode = "w+", dtype = np.float32, 
+                                               shape = (len(tickers), len(dates), len(self.fields)))
+            for i, position in enumerate(self.ticker_positions()):
+                values[i] = self.values[position, self.date_slice]
+            values.flush()
+            del values
+            sync_file(stem + ".values.npy")
+            with open(temp_path, "wb") as file:
+                np.save(file, np.array(version))
+            replace_file(temp_path, file_path)
+        except Exception:
+            for name in CUBE_FILES:
+                remove_temporary(stem + "." + name + ".npy")
+            raise
+        finally:
+            remove_temporary(temp_path)
+        self.remove_superseded(file_path, version)
+
+    @classmethod
+    def delete(cls, file_path):
+        '''
+        Removes the cube at file_path: its pointer first, so it is no longer opened,
+        then the files of every version.
+        '''
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # e.g. still open by a reader on Windows; the versions it points to are kept.
+            return
+        cls.remove_superseded(file_path, None)
+
+    @classmethod
+    def remove_superseded(cls, file_path, version):
+        '''
+        Removes files of the cube at file_path other than those of version (all of them
+        if version is None).
+        '''
+        folder, name = os.path.split(cls.sidecar_base(file_path))
+        for filename in os.listdir(folder or "."):
+            if not (filename.startswith(name + ".") and filename.endswith(".npy")):
+                continue
+            parts = filename[len(name) + 1:].split(".")
+            if len(parts) == 3 and parts[0] != version and parts[1] in CUBE_FILES:
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except OSError:
+                    # e.g. still mapped by a reader on Windows, retried on the next save.
+                    pass
+
+    def ticker_positions(self):
+        if isinstance(self.positions, slice):
+            return range(len(self.all_tickers))[self.positions]
+        return self.positions
+
+    @property
+    def tickers(self):
+        return [self.all_tickers[i] for i in self.ticker_positions()]
+
+    @property
+    def dates(self):
+        return self.all_dates[self.date_slice]
+
+    def position(self, ticker):
+        if self._lookup is None:
+            self._lookup = {ticker : i for i, ticker in enumerate(self.all_tickers)}
+        return self._lookup[ticker]
+
+    def select_tickers(self, tickers):
+        positions = np.array([self.position(ticker) for ticker in tickers], dtype = np.intp)
+        return PriceCube(self.values, self.all_tickers, self.all_dates, self.fields, positions, self.date_slice)
+
+    def up_to(self, end_date):
+        stop = self.all_dates.searchsorted(pandas.Timestamp(end_date), side = "right")
+        date_slice = slice(self.date_slice.start, min(stop, self.date_slice.stop))
+        return PriceCube(self.values, self.all_tickers, self.all_dates, self.fields, self.positions, date_slice)
+
+    def as_array(self):
+        '''
+        Returns the selected tickers x dates x fields values. This is a view when the 
+        ticker selection is contiguous, otherwise only the selected tickers are copied.
+        '''
+        return self.values[self.positions][:, self.date_slice]
+
+    def __getitem__(self, ticker):
+        values = self.values[self.position(ticker), self.date_slice]
+        return pandas.DataFrame(values, index = self.dates, columns = self.fields, copy = False)
+
+    def field(self, field):
+        '''
+        Returns a DataFrame of dates x tickers for one field, e.g. Close.
+        '''
+        values = self.values[self.positions, self.date_slice, self.fields.index(field)]
+        return pandas.DataFrame(values.T, index = self.dates, columns = self.tickers, copy = False)
+
+    def to_frame(self):
+        return pandas.concat({ticker : self[ticker] for ticker in self.tickers}, axis = 1)
 
 
 class Instruments(StorageResource):
+    '''
+    Instruments holds the price data for a set of tickers as a PriceCube.
+    errors records any tickers which could not be loaded when it was built.
+    '''
+    saves_atomically = True
 
     def __init__(self, exchange):
         self.exchange = exchange
         self.data = None
         self.start = None
         self.end = None
+        self.errors = {}
         
     def select_folder(self, store):
         self.exchange = store.exchange
         return store.workspace(self)
 
     def filename(self):
-        return self.exchange.lower() + "_instruments.pkl"
+        return self.exchange.lower() + "_instruments.npy"
 
     def load_from(self, file_path):
-        self.data = pandas.read_pickle(file_path)
-        self.start = self.data.iloc[0].index.min().to_pydatetime().date()
-        self.end = self.data.iloc[0].index.max().to_pydatetime().date()
+        self.data = PriceCube.open(file_path)
+        self.set_dates()
         return self
 
     def save_to(self, file_path):
-        self.data.to_pickle(file_path)
+        self.data.save(file_path)
+
+    def set_dates(self):
+        dates = self.data.dates
+        if len(dates):
+            self.start = dates[0].to_pydatetime().date()
+            self.end = dates[-1].to_pydatetime().date()
 
     @property
     def tickers(self):
-        return list(self.data.items)
+        return self.data.tickers
 
     def exclude(self, excluded_tickers):
         '''
         Removes the specified tickers from instrument set.
         '''
-        tickers = list(set(self.tickers) - set(excluded_tickers))
+        excluded_tickers = set(excluded_tickers)
+        tickers = [ticker for ticker in self.tickers if ticker not in excluded_tickers]
         new_set = Instruments(self.exchange)
         new_set.start = self.start
         new_set.end = self.end
-        new_set.data = self.data.loc[tickers, :, :]
+        new_set.data = self.data.select_tickers(tickers)
         return new_set
 
     def include_only(self, included_tickers):
         '''
         Removes tickers which are not in the provided ticker set
         '''
-        tickers = list(set(included_tickers).intersection(set(self.tickers)))
+        included_tickers = set(included_tickers)
+        tickers = [ticker for ticker in self.tickers if ticker in included_tickers]
         new_set = Instruments(self.exchange)
         new_set.start = self.start
         new_set.end = self.end
-        new_set.data = self.data.loc[tickers, :, :]
+        new_set.data = self.data.select_tickers(tickers)
         return new_set
 
     def up_to(self, end_date):
@@ -59,48 +475,80 @@ class Instruments(StorageResource):
         Returns a new instruments object with a revised (shorter) end date.
         '''
         new_set = Instruments(self.exchange)
-        new_set.start = self.start
-        new_set.data = self.data.loc[:, :, :end_date]
-        new_set.end = self.data.iloc[0].index.max().to_pydatetime().date()
+        new_set.data = self.data.up_to(end_date)
+        new_set.set_dates()
         return new_set
 
 
-class Indice(StorageResource):
+class PriceDataset(StorageResource):
+    '''
+    Price data for a single ticker, stored as part of a Parquet dataset partitioned by 
+    ticker and year. Setting start, end or columns restricts what is read on load.
+    Resources saved in the older pickle format are loaded from their legacy path.
+    '''
+    dataset_name = "prices.parquet"
+    saves_atomically = True
 
-    def __init__(self, ticker):
+    def __init__(self, ticker, start = None, end = None, columns = None):
         self.ticker = ticker
+        self.start = start
+        self.end = end
+        self.columns = columns
         self.data = None
 
-    def select_folder(self, store):
-        return store.indice_folder(self)
-
     def filename(self):
-        return self.ticker + ".pkl"
+        return self.dataset_name
+
+    def source_path(self, file_path):
+        if file_path.endswith(".pkl"):
+            return file_path
+        return os.path.join(file_path, "ticker=" + self.ticker)
+
+    def cache_key(self):
+        columns = None if self.columns is None else tuple(self.columns)
+        return (self.ticker, str(self.start), str(self.end), columns)
 
     def load_from(self, file_path):
-        self.data = pandas.read_pickle(file_path)
+        if file_path.endswith(".pkl"):
+            data = pandas.read_pickle(file_path)[self.start:self.end]
+            if self.columns is not None:
+                data = data[self.columns]
+            self.data = data
+        else:
+            self.data = read_ticker_prices(file_path, self.ticker, self.start, self.end, self.columns)
+        return self
 
     def save_to(self, file_path):
-        self.data.to_pickle(file_path)
+        write_price_dataset(file_path, {self.ticker : self.data})
 
-# TODO - provide methods for updating the data (i.e. for removing errors).
-# TODO - consider adding a merge method for price history to append new data rather than overwrite.
-class PriceHistory(StorageResource):
-    
-    def __init__(self, ticker):
-        self.ticker = ticker
-        self.data = None
+
+class Indice(PriceDataset):
+
+    dataset_name = "indices.parquet"
 
     def select_folder(self, store):
-        return store.price_history(self)
+        return store.indice_folder(self)
 
-    def filename(self):
-        return self.ticker + "prices.pkl"
+    def legacy_path(self, store):
+        return os.path.join(store.indice_folder(self), self.ticker + ".pkl")
 
-    def load_from(self, file_path):
-        self.data = pandas.read_pickle(file_path)
-        return self
 
-    def save_to(self, file_path):
-        self.data.to_pickle(file_path)
+# TODO - provide methods for updating the data (i.e. for removing errors).
+class PriceHistory(PriceDataset):
+
+    def merge(self, other):
+        '''
+        Combines other's prices into this history, with other taking precedence on overlapping dates.
+        '''
+        if other.ticker != self.ticker:
+            raise ValueError("Ticker must match")
+        if self.data is None:
+            self.data = other.data
+        else:
+            self.data = merge_prices(self.data, other.data)
+
+    def select_folder(self, store):
+        return store.price_dataset(self)
 
+    def legacy_path(self, store):
+        return os.path.join(store.price_history(self), self.ticker + "prices.pkl")
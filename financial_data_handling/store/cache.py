@@ -0,0 +1,115 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas
+
+
+def file_signature(path):
+    '''
+    Identifies the current version of a file as (mtime, size). For a folder (e.g. a 
+    Parquet dataset partition) the latest mtime, total size and file count of its
+    contents are used. Returns None if the path does not exist.
+    '''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if not os.path.isdir(path):
+        return (stat.st_mtime_ns, stat.st_size)
+    latest, total, count = stat.st_mtime_ns, 0, 0
+    for folder, _, files in os.walk(path):
+        latest = max(latest, os.stat(folder).st_mtime_ns)
+        for filename in files:
+            stat = os.stat(os.path.join(folder, filename))
+            latest = max(latest, stat.st_mtime_ns)
+            total += stat.st_size
+            count += 1
+    return (latest, total, count)
+
+
+def estimate_size(value, seen = None):
+    '''
+    Rough estimate of the memory held by a loaded resource, in bytes. Memory mapped
+    arrays count as nothing as their pages belong to the operating system's file cache.
+    '''
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pandas.DataFrame, pandas.Series)):
+        usage = value.memory_usage(deep = True)
+        return int(usage.sum()) if isinstance(usage, pandas.Series) else int(usage)
+    if isinstance(value, dict):
+        return sum(estimate_size(item, seen) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(item, seen) for item in value)
+    if hasattr(value, "__dict__"):
+        return estimate_size(vars(value), seen)
+    return sys.getsizeof(value)
+
+
+class ResourceCache():
+    '''
+    Least recently used cache of loaded resources, limited to max_bytes of estimated
+    memory. Each entry records the signature (mtime and size) of the file it was loaded
+    from and is discarded if the file has changed since.
+    The hits, misses and evictions counters accumulate over the life of the cache.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, signature):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or signature is None or entry[0] != signature:
+                if entry is not None:
+                    self.discard(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, signature, resource):
+        size = estimate_size(resource)
+        with self.lock:
+            if key in self.entries:
+                self.discard(key)
+            if signature is None or size > self.max_bytes:
+                return
+            self.entries[key] = (signature, resource, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.discard(oldest)
+                self.evictions += 1
+
+    def discard(self, key):
+        signature, resource, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        return {"hits" : self.hits, 
+                "misses" : self.misses, 
+                "evictions" : self.evictions, 
+                "entries" : len(self.entries), 
+                "bytes" : self.total_bytes}
@@ -0,0 +1,257 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+
+from formats import TEMPORARY_PREFIX
+from store.cache import file_signature
+
+
+CATALOG_FILENAME = "catalog.sqlite"
+
+CATALOG_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS resource (
+           path TEXT,
+           kind TEXT,
+           exchange TEXT,
+           ticker TEXT,
+           label TEXT,
+           date TEXT,
+           size INTEGER,
+           mtime INTEGER,
+           PRIMARY KEY (exchange, path))''',
+    '''CREATE INDEX IF NOT EXISTS ix_resource_kind_date
+           ON resource (exchange, kind, label, date)''',
+    '''CREATE INDEX IF NOT EXISTS ix_resource_ticker
+           ON resource (exchange, ticker, kind)''',
+    '''CREATE TABLE IF NOT EXISTS indexed_exchange (
+           exchange TEXT PRIMARY KEY)''',
+    '''CREATE TABLE IF NOT EXISTS exchange_folders (
+           exchange TEXT PRIMARY KEY,
+           signature TEXT)''']
+
+
+def catalog_rules(exchange):
+    '''
+    Patterns identifying the files written by Storage, used to rebuild the catalog
+    from the folders on disk. Each pattern matches a path relative to the root folder
+    (with '/' separators) and gives the kind of resource it holds. Named groups are
+    used for the ticker, label and date.
+    Files within a partitioned dataset are catalogued under their ticker partition.
+    '''
+    exchange = re.escape(exchange)
+    ticker_folder = "Data/" + exchange + "/(?P<ticker>[^/.]+)/"
+    return [
+        ("Valuations", "Valuations/" + exchange + r"/Valuation(?P<label>.*?)(?P<date>\d+)\.(parquet|xlsx)$"),
+        ("ListedCompanies", "Data/" + exchange + r"ListedCompanies\.(parquet|xlsx)$"),
+        ("PriceHistory", "(?P<path>Data/" + exchange + r"/prices\.parquet/ticker=(?P<ticker>[^/]+))/"),
+        ("Indice", r"(?P<path>Data/Indices/indices\.parquet/ticker=(?P<ticker>[^/]+))/"),
+        ("Indice", r"Data/Indices/(?P<ticker>[^/]+)\.pkl$"),
+        ("Instruments", "Workspace/" + exchange.lower() + r"_instruments\.npy$"),
+        ("PriceHistory", ticker_folder + r"(?P=ticker)prices\.pkl$"),
+        ("StatementWebpage", ticker_folder + r"Financials/(Annual|Interim)/(?P=ticker)(?P<label>\w+)\.html$"),
+        ("CMChistoricals", ticker_folder + r"Financials/(?P=ticker)historical\.pkl$"),
+        ("CMCpershare", ticker_folder + r"Financials/(?P=ticker)pershare\.pkl$"),
+        ("Financials", ticker_folder + r"Financials/(?P=ticker)(?P<label>annual|interim)\.pkl$"),
+        ("FundamentalsPanel", "Data/" + exchange + r"/fundamentals_(?P<label>annual|interim)\.parquet$"),
+        ("AlignedFundamentals", "Workspace/aligned/" + exchange.lower() + r"_(?P<label>annual|interim)_\w+\.npy$"),
+        ("AnalysisSummary", ticker_folder + r"(?P=ticker)analysis\.xlsx$"),
+        (None, ticker_folder)]
+
+
+class Catalog():
+    '''
+    Catalog keeps a persistent index of the files held under a Storage root folder in
+    a SQLite database, so that the latest dated file of a kind, or the files held for a
+    ticker, can be found with an index lookup rather than by listing folders.
+    Paths are kept relative to the root folder. Each exchange is indexed from disk the
+    first time it is used, and can be re-indexed with rebuild. Files shared between 
+    exchanges, e.g. indices, have an entry for each exchange.
+    Files written without going through Storage (e.g. price datasets written by the
+    download Handler) are not recorded directly. Instead the mtimes of the folders in
+    which tickers and datasets are added or removed are kept with the index, and
+    is_current reports the exchange as needing a rebuild once any of them change.
+    Storage checks this before each save and marks the folders current once the save
+    is recorded, so its own writes do not cause a rebuild.
+    '''
+    def __init__(self, root_folder):
+        self.root = root_folder
+        if not os.path.exists(root_folder):
+            os.makedirs(root_folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(root_folder, CATALOG_FILENAME),
+                                          timeout = 30, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            for statement in CATALOG_SCHEMA:
+                self.connection.execute(statement)
+
+    def relative_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def full_path(self, path):
+        return os.path.join(self.root, *path.split("/"))
+
+    def is_indexed(self, exchange):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM indexed_exchange WHERE exchange = ?",
+                                          (exchange,)).fetchone()
+        return row is not None
+
+    def watched_folders(self, exchange):
+        return [os.path.join(self.root, *parts) for parts in [
+            ("Data", exchange), 
+            ("Data", exchange, "prices.parquet"), 
+            ("Data", "Indices"), 
+            ("Data", "Indices", "indices.parquet"), 
+            ("Valuations", exchange), 
+            ("Workspace",)]]
+
+    def folder_signature(self, exchange):
+        mtimes = []
+        for folder in self.watched_folders(exchange):
+            try:
+                mtimes.append(os.stat(folder).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return json.dumps(mtimes)
+
+    def is_current(self, exchange):
+        '''
+        Whether the exchange has been indexed and nothing has been added to or removed
+        from its watched folders since the index was last brought up to date.
+        '''
+        with self.lock:
+            row = self.connection.execute("SELECT signature FROM exchange_folders WHERE exchange = ?",
+                                          (exchange,)).fetchone()
+        return row is not None and row[0] == self.folder_signature(exchange)
+
+    def mark_current(self, exchange, signature = None):
+        '''
+        Records the watched folders as they are now (or as given by signature) as 
+        matching the index, e.g. after recording a file saved through Storage.
+        '''
+        if signature is None:
+            signature = self.folder_signature(exchange)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO exchange_folders VALUES (?, ?)", (exchange, signature))
+
+    def record(self, path, kind, exchange, ticker = None, label = None, date = None):
+        '''
+        Adds or refreshes the entry for path, taking its size and mtime from disk.
+        '''
+        signature = file_signature(path)
+        if signature is None:
+            return self.remove(path)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO resource VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (self.relative_path(path), kind, exchange, ticker, label, date,
+                                     signature[1], signature[0]))
+
+    def remove(self, path):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM resource WHERE path = ?", (self.relative_path(path),))
+
+    def move(self, old_path, new_path):
+        '''
+        Moves the entries for old_path (e.g. after Storage.migrate_file) to new_path.
+        '''
+        signature = file_signature(new_path)
+        if signature is None:
+            return self.remove(old_path)
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE OR REPLACE resource SET path = ?, size = ?, mtime = ? WHERE path = ?",
+                                    (self.relative_path(new_path), signature[1], signature[0],
+                                     self.relative_path(old_path)))
+
+    def latest_date(self, exchange, kind, label = None):
+        '''
+        Returns the latest date recorded for the kind (and label, e.g. valuation type),
+        or None if there are none.
+        '''
+        with self.lock:
+            row = self.connection.execute('''SELECT max(date) FROM resource
+                                             WHERE exchange = ? AND kind = ? AND label IS ?''',
+                                          (exchange, kind, label)).fetchone()
+        return row[0]
+
+    def tickers(self, exchange, exclude = ()):
+        '''
+        Returns the tickers with any files held, other than files of the excluded kinds.
+        '''
+        query = "SELECT DISTINCT ticker FROM resource WHERE exchange = ? AND ticker IS NOT NULL"
+        if exclude:
+            query += " AND (kind IS NULL OR kind NOT IN ({}))".format(", ".join("?" * len(exclude)))
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY ticker", (exchange,) + tuple(exclude)).fetchall()
+        return [row[0] for row in rows]
+
+    def resources(self, exchange, kind, label = None):
+        '''
+        Returns (ticker, path) for each file of the kind (and label) held.
+        '''
+        with self.lock:
+            rows = self.connection.execute('''SELECT ticker, path FROM resource
+                                              WHERE exchange = ? AND kind = ? AND label IS ? ORDER BY ticker''',
+                                           (exchange, kind, label)).fetchall()
+        return [(ticker, self.full_path(path)) for ticker, path in rows]
+
+    def ticker_resources(self, exchange, ticker):
+        '''
+        Returns (kind, label, date, path) for each file held for the ticker.
+        '''
+        with self.lock:
+            rows = self.connection.execute('''SELECT kind, label, date, path FROM resource
+                                              WHERE exchange = ? AND ticker = ? ORDER BY kind, path''',
+                                           (exchange, ticker)).fetchall()
+        return [(kind, label, date, self.full_path(path)) for kind, label, date, path in rows]
+
+    def rebuild(self, exchange):
+        '''
+        Replaces all entries for the exchange with those found by walking the root folder.
+        Returns the number of entries recorded.
+        '''
+        rules = [(kind, re.compile(pattern)) for kind, pattern in catalog_rules(exchange)]
+        # Taken before walking, so changes made during the walk trigger another rebuild.
+        folders = self.folder_signature(exchange)
+        entries = {}
+        for top in ["Data", "Valuations", "Workspace"]:
+            for folder, _, files in os.walk(os.path.join(self.root, top)):
+                for filename in files:
+                    if filename.startswith(TEMPORARY_PREFIX):
+                        continue
+                    path = self.relative_path(os.path.join(folder, filename))
+                    entry = self.classify(path, rules)
+                    if entry is not None:
+                        entries[entry[0]] = entry
+        rows = []
+        for path, kind, ticker, label, date in entries.values():
+            signature = file_signature(self.full_path(path))
+            rows.append((path, kind, exchange, ticker, label, date, signature[1], signature[0]))
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM resource WHERE exchange = ?", (exchange,))
+            self.connection.executemany("INSERT OR REPLACE INTO resource VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR IGNORE INTO indexed_exchange VALUES (?)", (exchange,))
+            self.connection.execute("INSERT OR REPLACE INTO exchange_folders VALUES (?, ?)", (exchange, folders))
+        return len(rows)
+
+    def classify(self, path, rules):
+        for kind, rule in rules:
+            match = rule.match(path)
+            if match is not None:
+                fields = match.groupdict()
+                return (fields.get("path") or path, kind, fields.get("ticker"),
+                        fields.get("label"), fields.get("date"))
+        return None
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    import sys
+    args = sys.argv[1:]
+    catalog = Catalog(args[1] if len(args) > 1 else "D:\\Investing\\")
+    print("Catalogued {} files".format(catalog.rebuild(args[0] if len(args) > 0 else "ASX")))
@@ -1,13 +1,58 @@
-from sqlalchemy import Column, ForeignKey, Integer, Float, String, Boolean, Date, create_engine
+from sqlalchemy import Column, ForeignKey, Integer, Float, String, Boolean, Date, create_engine, select, insert, or_, func
+from sqlalchemy import Index, inspect, text, type_coerce
+from sqlalchemy.dialects import sqlite, postgresql
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import relationship, backref, sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import relationship, backref, sessionmaker, scoped_session
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
+from contextlib import contextmanager
 from datetime import date
+import os
+import numpy
+import pandas
 from pandas import DataFrame
 
 Base = declarative_base()
-db_session = sessionmaker()
+
+
+SQLITE_PRAGMAS = {"journal_mode" : "WAL", 
+                  "synchronous" : "NORMAL", 
+                  "busy_timeout" : 30000, 
+                  "cache_size" : -64000}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute("PRAGMA {0} = {1}".format(pragma, value))
+    cursor.close()
+
+
+def configure_sqlite(engine):
+    '''
+    Applies SQLITE_PRAGMAS to every new connection made by the engine. WAL mode lets
+    readers carry on while a writer commits, and the busy timeout makes writers from
+    other threads or processes wait their turn rather than fail with "database is locked".
+    '''
+    if not event.contains(engine, "connect", set_sqlite_pragmas):
+        event.listen(engine, "connect", set_sqlite_pragmas)
+
+
+def create_db_engine(conn_string, pool_size = 5, max_overflow = 10):
+    '''
+    Creates an engine with a connection pool sized for concurrent workers.
+    SQLite engines are configured for concurrent access (see configure_sqlite).
+    '''
+    if conn_string.startswith("sqlite"):
+        engine = create_engine(conn_string, connect_args = {"timeout" : 30, "check_same_thread" : False}, 
+                               pool_pre_ping = True)
+    else:
+        engine = create_engine(conn_string, pool_size = pool_size, max_overflow = max_overflow, 
+                               pool_pre_ping = True)
+    if engine.dialect.name == "sqlite":
+        configure_sqlite(engine)
+    return engine
 
 
 class Exchange(Base):
@@ -46,8 +91,10 @@ class LineItem(Base):
     The cumulative field specifies whether the item accumulates over successive
     reporting periods. E.g. revenue is cumulative, whereas assets are not. This
     is used when converting from half yearly to annual values.
+    Names are unique, so concurrent writers cannot add the same line item twice.
     '''
     __tablename__ = 'line_item'
+    __table_args__ = (Index('ix_line_item_name', 'name', unique = True), )
 
     id = Column(Integer, primary_key = True)
     name = Column(String(250), nullable = False)
@@ -62,21 +109,32 @@ class StatementItem(Base):
     '''
     __tablename__ = 'statement_item'
     
-    statement_type = Column(Integer, ForeignKey('statement.type'), primary_key = True)
+    statement_type = Column(String(50), ForeignKey('statement.type'), primary_key = True)
     line_item_id = Column(Integer, ForeignKey('line_item.id'), primary_key = True)
     row_num = Column(Integer, nullable = False)
     statement = relationship(Statement, backref = backref("line_item_assoc"))
     line_item = relationship(LineItem, backref = backref("statement_assoc"))
+    __table_args__ = (Index('ix_statement_item_line_item', 'line_item_id', 'statement_type', 'row_num'), )
 
 
 class StatementFact(Base):
     '''
-    StatementFacts record actual results for a given company and time.
+    StatementFacts record actual results for a given company, period (annual or 
+    interim) and time. Period is part of the key as an annual period and an interim
+    period can end on the same date.
+    The primary key serves ticker-major access (a company's history), and on SQLite
+    the table is stored WITHOUT ROWID so that the key is also the table's storage order.
+    The line item/date index covers cross-sectional queries, e.g. Revenue for all 
+    companies at a date, without touching the table.
     '''
     __tablename__ = 'statement_fact'
+    __table_args__ = (
+        Index('ix_statement_fact_line_item_date', 'line_item_id', 'period', 'date', 'ticker', 'value'), 
+        {'sqlite_with_rowid' : False})
 
     ticker = Column(String(10), ForeignKey('company.ticker'), primary_key = True)
     line_item_id = Column(Integer, ForeignKey('line_item.id'), primary_key = True)
+    period = Column(String(10), nullable = False, primary_key = True, server_default = "annual")
     date = Column(Date, nullable = False, primary_key = True)
     value = Column(Float)
     company = relationship(Company, backref = backref("line_item_assoc"))
@@ -84,22 +142,86 @@ class StatementFact(Base):
 
 
 
-class DbInterface:
+UPSERT_DIALECTS = {"sqlite" : sqlite, "postgresql" : postgresql}
+
+
+def upsert_statement(engine, table, key_columns, update_columns, changed_only = False):
+    '''
+    Returns an insert statement for table which, on dialects supporting it (SQLite,
+    PostgreSQL), updates update_columns of rows whose key_columns already exist.
+    With changed_only, existing rows are only written to when a value differs.
+    Other dialects get a plain insert.
+    '''
+    if engine.dialect.name not in UPSERT_DIALECTS:
+        return insert(table)
+    statement = UPSERT_DIALECTS[engine.dialect.name].insert(table)
+    if not update_columns:
+        return statement.on_conflict_do_nothing(index_elements = key_columns)
+    where = None
+    if changed_only:
+        where = or_(*[table.c[column].is_distinct_from(statement.excluded[column]) for column in update_columns])
+    return statement.on_conflict_do_update(index_elements = key_columns, 
+        set_ = {column : statement.excluded[column] for column in update_columns}, where = where)
+
 
-    def __init__(self, db_source):
+class DbInterface:
+    '''
+    DbInterface owns its engine and session factory. The session property gives each
+    thread its own session, so one DbInterface can be shared between worker threads.
+    Use session_scope for units of work which should commit or roll back together.
+    Worker processes should create their own DbInterface; if one is inherited across
+    a fork its pooled connections are discarded on first use in the child.
+    '''
+    def __init__(self, db_source, pool_size = 5, max_overflow = 10):
         if isinstance(db_source, Engine):
-            db_session.configure(bind = db_source)
+            self.engine = db_source
+            if self.engine.dialect.name == "sqlite":
+                configure_sqlite(self.engine)
         elif isinstance(db_source, str):
-            db_session.configure(bind = create_engine(db_source))
+            self.engine = create_db_engine(db_source, pool_size, max_overflow)
         else:
             raise TypeError("db_source must be an sqlalchemy engine instance or connection string.")
-        self.session = db_session()
+        self.sessions = scoped_session(sessionmaker(bind = self.engine))
+        self.pid = os.getpid()
+        self.line_item_cache = None
+
+    @property
+    def session(self):
+        self.check_process()
+        return self.sessions()
+
+    @contextmanager
+    def session_scope(self):
+        '''
+        Provides a new session which is committed on exit, or rolled back on error, and then closed.
+        '''
+        self.check_process()
+        session = self.sessions.session_factory()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def check_process(self):
+        if os.getpid() != self.pid:
+            # Connections can't be shared with the parent process, start afresh.
+            self.engine.dispose(close = False)
+            self.sessions = scoped_session(sessionmaker(bind = self.engine))
+            self.pid = os.getpid()
+
+    def close(self):
+        self.sessions.remove()
+        self.engine.dispose()
 
     def getExchange(self, exchange):
         try:
             exchange = self.session.query(Exchange).filter(Exchange.symbol == exchange).one()
         except NoResultFound as e:
-            raise ValueError(ticker + " does not exist")
+            raise ValueError(exchange + " does not exist")
         return exchange
 
     def getListedCompanies(self, exchange):
@@ -114,14 +236,21 @@ class DbInterface:
         return company
 
     def addCompanies(self, listed_companies):
-        current_companies = self.getListedCompanies(listed_companies.exchange)
-        additional_companies = listed_companies.as_record_list()
-        additional_tickers = [company.ticker for company in additional_companies]
-        for existing in current_companies:
-            if existing.ticker in additional_tickers:
-                additional_companies.pop(additional_tickers.index(existing.ticker))
-        self.session.add_all(additional_companies)
-        self.session.commit()
+        '''
+        Adds every company in the listing in one statement batch. Companies which already
+        exist have their sector and industry group updated where these have changed.
+        '''
+        companies = listed_companies.as_company_frame()
+        table = Company.__table__
+        statement = upsert_statement(self.engine, table, ["ticker", "exchange"], 
+                                     ["sector", "industry_group"], changed_only = True)
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name not in UPSERT_DIALECTS:
+                existing = connection.execute(select(Company.ticker).where(
+                    Company.exchange == listed_companies.exchange)).scalars().all()
+                companies = companies[~companies["ticker"].isin(existing)]
+            if len(companies):
+                connection.execute(statement, companies.to_dict("records"))
 
     def getLineItem(self, type):
         try:
@@ -130,28 +259,173 @@ class DbInterface:
             raise ValueError(type + " does not exist")
         return line
 
-    def addStatementFact(self, ticker, type, date, value):
+    def addStatementFact(self, ticker, type, date, value, period = "annual"):
         company = self.getCompany(ticker)
         line = self.getLineItem(type)
-        self.session.add(StatementFact(company = company, line_item = line, date = date, value = value))
+        self.session.add(StatementFact(company = company, line_item = line, period = period, date = date, value = value))
         self.session.commit()
         
-    def getStatement(self, statement_type, ticker):
-        result = self.session.query(StatementItem.row_num, StatementFact.date, LineItem.name, LineItem.cumulative, StatementFact.value).filter(
-        StatementFact.line_item_id == LineItem.id).filter(
-        LineItem.id == StatementItem.line_item_id).filter(
-        StatementItem.statement.has(Statement.type == statement_type)).filter(
-        StatementFact.company.has(Company.ticker == ticker)).all()
-        df = DataFrame(result)
-        df.sort_values(by = 'row_num')
-        return df.pivot(index = 'date', columns = 'name', values = 'value')
+    def lineItemIds(self, refresh = False):
+        '''
+        Returns a dict of line item name -> id, cached after the first call.
+        '''
+        if self.line_item_cache is None or refresh:
+            with self.engine.connect() as connection:
+                rows = connection.execute(select(LineItem.id, LineItem.name)).all()
+            self.line_item_cache = {name : id for id, name in rows}
+        return self.line_item_cache
+
+    def addLineItems(self, names):
+        '''
+        Adds the line items not already held and returns the refreshed name -> id dict.
+        Names added meanwhile by another thread or process are skipped by the unique
+        index on name, and their ids are picked up by the refresh.
+        '''
+        known = self.lineItemIds(refresh = True)
+        names = [name for name in dict.fromkeys(names) if name not in known]
+        if names:
+            statement = upsert_statement(self.engine, LineItem.__table__, ["name"], [])
+            with self.engine.begin() as connection:
+                connection.execute(statement, [{"name" : name} for name in names])
+        return self.lineItemIds(refresh = True)
+
+    def addFinancials(self, financials, batch_size = 50000, create_missing = False):
+        return self.addStatementFacts(financials.as_long_format(), batch_size, create_missing)
+
+    def addStatementFacts(self, facts, batch_size = 50000, create_missing = False):
+        '''
+        Bulk equivalent of addStatementFact. facts is a long format DataFrame with
+        ticker, period, line_item, date and value columns, covering any number of tickers
+        (e.g. from Financials.as_long_format). Line item ids are resolved from the
+        in memory cache and facts are upserted batch_size rows per transaction.
+        Unknown line items raise a ValueError unless create_missing is True.
+        Returns the number of facts written.
+        '''
+        if "period" not in facts:
+            raise ValueError("Facts need a period column, annual and interim periods can share dates")
+        facts = facts[facts["value"].notnull()]
+        line_items = self.lineItemIds()
+        missing = set(facts["line_item"].unique()) - set(line_items)
+        if missing and create_missing:
+            line_items = self.addLineItems(sorted(missing))
+        elif missing:
+            raise ValueError("Line items do not exist: " + ", ".join(sorted(missing)))
+        tickers = facts["ticker"].unique().tolist()
+        with self.engine.connect() as connection:
+            known = connection.execute(select(Company.ticker).where(Company.ticker.in_(tickers))).scalars().all()
+        unknown = set(tickers) - set(known)
+        if unknown:
+            raise ValueError("Companies do not exist: " + ", ".join(sorted(unknown)))
+
+        records = list(zip(facts["ticker"].tolist(), 
+                           facts["line_item"].map(line_items).tolist(), 
+                           facts["period"].tolist(), 
+                           pandas.DatetimeIndex(facts["date"]).date.tolist(), 
+                           facts["value"].astype(float).tolist()))
+        table = StatementFact.__table__
+        statement = upsert_statement(self.engine, table, ["ticker", "line_item_id", "period", "date"], ["value"])
+        for batch_start in range(0, len(records), batch_size):
+            batch = [{"ticker" : ticker, "line_item_id" : line_item_id, "period" : period, "date" : date, "value" : value} 
+                     for ticker, line_item_id, period, date, value in records[batch_start:(batch_start + batch_size)]]
+            with self.engine.begin() as connection:
+                connection.execute(statement, batch)
+        return len(records)
+
+    def getStatement(self, statement_type, ticker, period = "annual"):
+        statements = self.getStatements([statement_type], [ticker], period = period)
+        if statements.empty:
+            return statements
+        return statements.xs(ticker, level = "ticker")
+
+    def getStatements(self, statement_types, tickers = None, chunk_size = 50000, period = "annual"):
+        '''
+        Returns the facts for many tickers and statement types for one period (annual or
+        interim) from one query, as a DataFrame indexed by (ticker, date) with a column 
+        per line item, in statement then row_num order.
+        If tickers is None all companies are returned.
+        Rows are streamed from the cursor in chunks straight into NumPy arrays.
+        '''
+        if isinstance(statement_types, str):
+            statement_types = [statement_types]
+        # Dates are fetched as stored and converted in one vectorized step below,
+        # rather than by a result processor on every row.
+        query = select(StatementFact.ticker, type_coerce(StatementFact.date, String), StatementItem.statement_type, 
+                       StatementItem.row_num, LineItem.name, StatementFact.value).select_from(
+            StatementFact).join(
+            LineItem, LineItem.id == StatementFact.line_item_id).join(
+            StatementItem, StatementItem.line_item_id == LineItem.id).where(
+            StatementItem.statement_type.in_(statement_types)).where(
+            StatementFact.period == period)
+        if tickers is not None:
+            query = query.where(StatementFact.ticker.in_(list(tickers)))
+
+        columns = [[] for _ in range(6)]
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results = True).execute(query)
+            for chunk in result.partitions(chunk_size):
+                for column, values in zip(columns, zip(*chunk)):
+                    column.append(numpy.array(values, dtype = object))
+        ticker, date, statement, row_num, name, value = [
+            numpy.concatenate(column) if column else numpy.array([], dtype = object) for column in columns]
+
+        # Line item columns ordered by statement (as requested) then row number.
+        order = numpy.lexsort((row_num.astype(int), pandas.Index(statement_types).get_indexer(statement)))
+        line_items = pandas.Index(pandas.unique(name[order]), name = "name")
+        rows = pandas.MultiIndex.from_arrays([ticker.astype(str), pandas.to_datetime(date)], names = ["ticker", "date"])
+        unique_rows = rows.unique().sort_values()
+        values = numpy.full((len(unique_rows), len(line_items)), numpy.nan)
+        values[unique_rows.get_indexer(rows), line_items.get_indexer(name)] = value.astype(float)
+        return DataFrame(values, index = unique_rows, columns = line_items)
+
+
+def migrate_schema(engine):
+    '''
+    Brings a database created with the original schema up to date:
+        - statement_item.statement_type becomes a String, matching statement.type
+        - statement_fact is rebuilt as a WITHOUT ROWID table on SQLite
+        - statement_fact gains a period column in its key; existing facts, which did 
+          not record their period, are taken to be annual
+        - the statement_fact and statement_item indexes, and the unique index on 
+          line_item.name, are created. Duplicate line item names must be merged first.
+    Tables needing a new definition are renamed, recreated and their rows copied 
+    across within one transaction. Safe to run repeatedly.
+    '''
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        item_columns = {column["name"] : column["type"] for column in inspector.get_columns("statement_item")}
+        if not isinstance(item_columns["statement_type"], String):
+            rebuild_table(connection, inspector, StatementItem.__table__)
+        if engine.dialect.name == "sqlite":
+            table_sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'statement_fact'")).scalar()
+            fact_columns = [column["name"] for column in inspector.get_columns("statement_fact")]
+            if "WITHOUT ROWID" not in table_sql.upper() or "period" not in fact_columns:
+                rebuild_table(connection, inspector, StatementFact.__table__)
+        duplicates = connection.execute(select(LineItem.name).group_by(LineItem.name).having(
+            func.count() > 1)).scalars().all()
+        if duplicates:
+            raise ValueError("Line items must be unique, merge the duplicates of: " + ", ".join(duplicates))
+        for table in [LineItem.__table__, StatementItem.__table__, StatementFact.__table__]:
+            for index in table.indexes:
+                index.create(connection, checkfirst = True)
+    Base.metadata.create_all(engine)
+
+
+def rebuild_table(connection, inspector, table):
+    old_name = table.name + "_old"
+    for index in inspector.get_indexes(table.name):
+        connection.execute(text("DROP INDEX {0}".format(index["name"])))
+    connection.execute(text("ALTER TABLE {0} RENAME TO {1}".format(table.name, old_name)))
+    old_columns = [column["name"] for column in inspector.get_columns(old_name)]
+    table.create(connection)
+    # New columns take their server default.
+    columns = ", ".join(column.name for column in table.columns if column.name in old_columns)
+    connection.execute(text("INSERT INTO {0} ({1}) SELECT {1} FROM {2}".format(table.name, columns, old_name)))
+    connection.execute(text("DROP TABLE {0}".format(old_name)))
 
 
 def build_database(engine):
-    Base.metadata.bind = engine
-    Base.metadata.create_all()
-    db_session.configure(bind = engine)
-    session = db_session()
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind = engine)()
 
     session.add_all([
         Exchange(symbol = "NYSE", name = "New York Stock Exchange", country = "U.S.", currency = "USD"), 
@@ -162,11 +436,9 @@ def build_database(engine):
 test_conn_string = "sqlite:///D:\\Investing\\Data\\test.db"
     
 def buildTestDB(engine):
-        Base.metadata.bind = engine
-        Base.metadata.create_all()
+        Base.metadata.create_all(engine)
 
-        db_session.configure(bind = engine)
-        session = db_session()
+        session = sessionmaker(bind = engine)()
         
         mld = Company(ticker = "MLD", name = "MACA Ltd")
         ccp = Company(ticker = "CCP", name = "Credit Corp")
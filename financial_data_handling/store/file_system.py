@@ -5,20 +5,38 @@ import shutil
 import pandas
 import datetime
 import pickle
+from contextlib import contextmanager
 from pandas_datareader import data as pd_data
 from pandas_datareader import base as pd_base
 from bs4 import BeautifulSoup
 
-from formats.price_history import Instruments, Indice
-from formats.fundamentals import Valuations, StackedValuations
-
+from formats import temporary_path, replace_file, remove_temporary, sync_file, sync_folder
+from formats.price_history import Instruments, Indice, PriceHistory, read_price_dataset, price_dataset_tickers
+from formats.point_in_time import AlignedFundamentals
+from formats.fundamentals import Financials, Valuations, StackedValuations, FundamentalsPanel, financials_panel
+from store.cache import ResourceCache, file_signature
+from store.catalog import Catalog
+from store.streaming import batched, prefetched
 
 
 class Storage():
-    
-    def __init__(self, exchange = "ASX", root_folder = "D:\\Investing\\"):
+    '''
+    Storage maps resources to their locations under the root folder and loads and saves them.
+    If cache_bytes is given, loaded resources are kept in an in-process LRU cache of that
+    many bytes. Cached resources are shared between callers, and are reloaded once their 
+    file changes on disk. Saves write through to the cache.
+    Saved files are recorded in a catalog under the root folder, which is used to find
+    tickers and the latest dated files without listing folders. The catalog is rebuilt
+    when files are added or removed by other writers (see Catalog.is_current).
+    Saves are atomic: readers only ever see complete files.
+    '''
+    def __init__(self, exchange = "ASX", root_folder = "D:\\Investing\\", cache_bytes = None):
         self.root = root_folder
         self.exchange = exchange
+        self.cache = None if cache_bytes is None else ResourceCache(cache_bytes)
+        self._catalog = None
+        self.pending = None
+        self.pending_limit = None
 
     @property
     def data(self):
@@ -28,19 +46,154 @@ class Storage():
     def valuations(self):
         return os.path.join(self.root, "Valuations", self.exchange)
 
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            self._catalog = Catalog(self.root)
+        # Uncommitted saves have temporary files in the watched folders, and are
+        # recorded when committed.
+        if not self.pending and not self._catalog.is_current(self.exchange):
+            self._catalog.rebuild(self.exchange)
+        return self._catalog
+
+    def rebuild_catalog(self):
+        return self.catalog.rebuild(self.exchange)
+
     def workspace(self, resource):
         return os.path.join(self.root, "Workspace")
 
     def load(self, resource):
-        folder = resource.select_folder(self)
-        filename = resource.filename()
-        return resource.load_from(os.path.join(folder, filename))
+        file_path = self.find_file(resource)
+        if self.cache is None:
+            return resource.load_from(file_path)
+        key = self.cache_key(resource, file_path)
+        signature = file_signature(resource.source_path(file_path))
+        loaded = self.cache.get(key, signature)
+        if loaded is None:
+            loaded = resource.load_from(file_path)
+            self.cache.put(key, signature, loaded)
+        return loaded
 
     def save(self, resource):
+        '''
+        Saves resource by writing it to a temporary file, flushing it to disk and renaming
+        it over the resource's file, so an interrupted save never leaves a partial file.
+        Within batched_commits the flush and rename are deferred to the end of the batch.
+        The catalog is brought up to date before writing, so that the folders changed
+        by this save are then recorded as current rather than triggering a rebuild.
+        '''
+        self.catalog
         folder = resource.select_folder(self)
         self.check_directory(folder)
         file_path = os.path.join(folder, resource.filename())
-        resource.save_to(file_path)
+        if resource.saves_atomically:
+            resource.save_to(file_path)
+            return self.saved(resource, file_path)
+        temp_path = temporary_path(file_path)
+        try:
+            resource.save_to(temp_path)
+        except BaseException:
+            remove_temporary(temp_path)
+            raise
+        if self.pending is None:
+            replace_file(temp_path, file_path)
+            self.saved(resource, file_path)
+        else:
+            self.pending.append((resource, temp_path, file_path))
+            if len(self.pending) >= self.pending_limit:
+                self.commit_pending()
+
+    def saved(self, resource, file_path):
+        self.record(resource, file_path)
+        if self.cache is not None:
+            signature = file_signature(resource.source_path(file_path))
+            self.cache.put(self.cache_key(resource, file_path), signature, resource)
+
+    @contextmanager
+    def batched_commits(self, max_pending = 500):
+        '''
+        Groups saves made within the block so they are committed together: one sync of
+        all written files, then the renames, then one sync of each folder renamed into.
+        Up to max_pending saves are held before committing. Saved files only become
+        visible when committed; saves which completed are still committed if the block 
+        is interrupted, e.g.
+            with store.batched_commits():
+                for financials in downloaded:
+                    store.save(financials)
+        '''
+        if self.pending is not None:
+            yield self
+            return
+        self.pending = []
+        self.pending_limit = max_pending
+        try:
+            yield self
+        finally:
+            try:
+                self.commit_pending()
+            finally:
+                self.pending = None
+
+    def commit_pending(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        if hasattr(os, "sync"):
+            os.sync()
+        else:
+            for _, temp_path, _ in pending:
+                sync_file(temp_path)
+        for _, temp_path, file_path in pending:
+            os.replace(temp_path, file_path)
+        for folder in set(os.path.dirname(file_path) for _, _, file_path in pending):
+            sync_folder(folder)
+        for resource, _, file_path in pending:
+            self.saved(resource, file_path)
+
+    def export_excel(self, resource):
+        '''
+        Writes resource out as an Excel report alongside its stored file. Excel is 
+        only used for reports; loading always prefers the stored format.
+        '''
+        file_path = resource.excel_path(self)
+        self.check_directory(file_path)
+        resource.to_excel(file_path)
+        return file_path
+
+    def record(self, resource, file_path):
+        kind, label, date = resource.catalog_entry()
+        # Checked before the save was written (see save).
+        catalog = self._catalog
+        catalog.record(resource.source_path(file_path), kind, self.exchange, 
+                       getattr(resource, "ticker", None), label, date)
+        # The catalog was current before this save, and now includes it.
+        catalog.mark_current(self.exchange)
+
+    def tickers(self):
+        '''
+        Tickers with data held for the exchange, not counting indices.
+        '''
+        return self.catalog.tickers(self.exchange, exclude = ["Indice"])
+
+    def find_file(self, resource):
+        '''
+        Returns the path to load resource from, which is its legacy path if it has
+        not yet been saved in its current format.
+        '''
+        file_path = os.path.join(resource.select_folder(self), resource.filename())
+        if not os.path.exists(resource.source_path(file_path)):
+            legacy_path = resource.legacy_path(self)
+            if legacy_path is not None and os.path.exists(legacy_path):
+                return legacy_path
+        return file_path
+
+    def cache_key(self, resource, file_path):
+        return (type(resource).__name__, file_path) + resource.cache_key()
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
 
     def exchange_information(self, resource):
         return os.path.join(self.root, "Data")
@@ -66,6 +219,9 @@ class Storage():
     def price_history(self, resource):
         return self.stock_folder(resource)
 
+    def price_dataset(self, resource):
+        return self.data
+
     def analysis_summary(self, resource):
         return self.stock_folder(resource)
 
@@ -83,9 +239,12 @@ class Storage():
         return [filename for filename in all_files if search_term in filename]
 
     def migrate_file(self, old_folder, destination, filename):
+        catalog = self.catalog
         dest_file = os.path.join(destination, filename)
         self.check_directory(dest_file)
         shutil.move(os.path.join(old_folder, filename), dest_file)
+        catalog.move(os.path.join(old_folder, filename), dest_file)
+        catalog.mark_current(self.exchange)
 
     def get_instruments(self, excluded_tickers = None):
         instruments = Instruments(self.exchange)
@@ -97,16 +256,157 @@ class Storage():
     def get_valuations(self, type, date = None):
         if date is None:
             # Find the most recent valuations
-            files = os.listdir(self.valuations)
-            filename = StackedValuations(type).filename()
-            date = self.find_latest_date(files, filename)
+            date = self.catalog.latest_date(self.exchange, "Valuations", type)
+            if date is None:
+                raise IOError("No {0} valuations found in {1}".format(type, self.valuations))
         valuations = StackedValuations(type, date)
         return self.load(valuations)
 
+    def update_fundamentals(self, period):
+        '''
+        Brings the exchange's fundamentals panel for period up to date with its stored 
+        Financials. Only tickers whose Financials file has changed since it was last 
+        added are reloaded; tickers no longer held are dropped.
+        Returns a dict of ticker -> error for any Financials which could not be loaded,
+        or which had columns left out because their labels are not period end dates.
+        '''
+        panel = FundamentalsPanel(self.exchange, period)
+        file_path = os.path.join(panel.select_folder(self), panel.filename())
+        if os.path.exists(file_path):
+            panel.load_sources(file_path)
+        current = {}
+        for ticker, path in self.catalog.resources(self.exchange, "Financials", panel.period):
+            signature = file_signature(path)
+            # A catalogued file which has since been deleted counts as removed.
+            if signature is not None:
+                current[ticker] = list(signature)
+        removed = [ticker for ticker in panel.sources if ticker not in current]
+        changed = [ticker for ticker in current if panel.sources.get(ticker) != current[ticker]]
+        if not removed and not changed:
+            return {}
+        if os.path.exists(file_path):
+            panel.load_from(file_path)
+        errors = {}
+        loaded = []
+        for ticker in changed:
+            try:
+                loaded.append(self.load(Financials(ticker, period)))
+            except Exception as E:
+                errors[ticker] = str(E)
+            else:
+                panel.sources[ticker] = current[ticker]
+        for ticker in removed:
+            del panel.sources[ticker]
+        panel.replace_tickers(removed + [financials.ticker for financials in loaded], financials_panel(loaded, errors))
+        self.save(panel)
+        return errors
+
+    def query_fundamentals(self, period, tickers = None, statements = None, line_items = None, 
+                           start = None, end = None):
+        '''
+        Reads the rows of the fundamentals panel matching the given tickers, statements,
+        line items and period end range. e.g. Net Income for every ticker:
+            store.query_fundamentals("annual", line_items = ["Net Income"])
+        '''
+        panel = FundamentalsPanel(self.exchange, period, tickers, statements, line_items, start, end)
+        return self.load(panel).data
+
+    def aligned_fundamentals(self, line_items, dates, tickers = None, period = "annual", lag = None):
+        '''
+        Returns line items from the fundamentals panel as of each of dates (e.g. an 
+        Instruments date index) as a PriceCube of tickers x dates x line_items, where 
+        each statement is only used from its period end plus the reporting lag. 
+        Results are cached on disk until the panel changes, and replace those cached
+        from the earlier panel.
+        '''
+        panel = FundamentalsPanel(self.exchange, period)
+        source = file_signature(os.path.join(panel.select_folder(self), panel.filename()))
+        aligned = AlignedFundamentals(self.exchange, period, line_items, dates, tickers, lag, source)
+        try:
+            return self.load(aligned).data
+        except FileNotFoundError:
+            pass
+        facts = self.query_fundamentals(period, tickers = tickers, line_items = list(line_items))
+        self.save(aligned.build(facts))
+        for file_path in aligned.remove_superseded(aligned.select_folder(self)):
+            self.catalog.remove(file_path)
+        return aligned.data
+
     def get_indice(self, ticker):
         indice = Indice(ticker)
         return self.load(indice)
 
+    def iter_tickers(self, batch_size = 100, tickers = None):
+        '''
+        Yields the exchange's tickers (or those given) in lists of up to batch_size.
+        '''
+        if tickers is None:
+            tickers = self.tickers()
+        return batched(tickers, batch_size)
+
+    def iter_resources(self, resource_for, tickers = None, batch_size = 100, prefetch = 1):
+        '''
+        Streams resources for many tickers, e.g. every ticker's annual Financials:
+            for ticker, financials, error in store.iter_resources(lambda ticker: Financials(ticker, "annual")):
+        Yields (ticker, resource, error) with exactly one of resource and error None.
+        Resources are loaded batch_size tickers at a time on a background thread, up
+        to prefetch batches ahead, so memory use does not grow with the number of tickers.
+        '''
+        def load_batch(batch):
+            results = []
+            for ticker in batch:
+                try:
+                    results.append((ticker, self.load(resource_for(ticker)), None))
+                except Exception as E:
+                    results.append((ticker, None, E))
+            return results
+        for results in prefetched(self.iter_tickers(batch_size, tickers), load_batch, prefetch):
+            for result in results:
+                yield result
+
+    def iter_prices(self, tickers = None, batch_size = 200, start = None, end = None, prefetch = 1):
+        '''
+        Streams raw prices from the price dataset, yielding a long DataFrame (with Date 
+        and ticker columns) for each batch of up to batch_size tickers. Batches with no
+        prices stored (e.g. only delisted tickers) are skipped.
+        '''
+        dataset_path = self.price_dataset_path()
+        def load_batch(batch):
+            try:
+                return read_price_dataset(dataset_path, batch, start, end)
+            except FileNotFoundError:
+                return None
+        for prices in prefetched(self.iter_tickers(batch_size, tickers), load_batch, prefetch):
+            if prices is not None:
+                yield prices
+
+    def iter_price_windows(self, start, end, freq = "YS", tickers = None, prefetch = 1):
+        '''
+        Streams raw prices for all tickers (or those given) through time, yielding 
+        (window_start, window_end, prices) for consecutive date windows from start to 
+        end, where freq sets the window length, e.g. "YS" for calendar years or "QS" 
+        for quarters. Only the dataset partitions overlapping each window are read.
+        '''
+        dataset_path = self.price_dataset_path()
+        if tickers is None:
+            tickers = price_dataset_tickers(dataset_path)
+        start, end = pandas.Timestamp(start), pandas.Timestamp(end)
+        starts = pandas.date_range(start, end, freq = freq)
+        if not len(starts) or starts[0] != start:
+            starts = starts.insert(0, start)
+        ends = list(starts[1:] - pandas.Timedelta(1, "D")) + [end]
+        windows = list(zip(starts, ends))
+        def load_window(window):
+            try:
+                prices = read_price_dataset(dataset_path, tickers, window[0], window[1])
+            except FileNotFoundError:
+                prices = None
+            return window + (prices,)
+        return prefetched(iter(windows), load_window, prefetch)
+
+    def price_dataset_path(self):
+        return os.path.join(self.price_dataset(PriceHistory(None)), PriceHistory.dataset_name)
+
     def find_latest_date(self, files, filename):
         """
         From a list of files (e.g. retrieved from a directory), and the
@@ -117,8 +417,11 @@ class Storage():
         """
         label = filename[:filename.find("*")]
         suffix = filename[(filename.find("*") + 1):]
-        valuation_files = [file for file in files if label in file]
-        datenums = [int(file.replace(label, '').replace(suffix, '')) for file in valuation_files]
+        dates = [file[len(label):-len(suffix)] for file in files 
+                 if file.startswith(label) and file.endswith(suffix)]
+        datenums = [int(date) for date in dates if date.isdigit()]
+        if not datenums:
+            return ""
         latest_date = max(datenums)
         return str(latest_date)
 
@@ -0,0 +1,117 @@
+'''
+One-shot tools for moving existing data files into newer storage formats.
+Run from the financial_data_handling folder, e.g.
+    python -m store.migrate prices ASX D:\\Investing\\
+    python -m store.migrate valuations ASX D:\\Investing\\
+'''
+import os
+import sys
+import pandas
+
+from store.file_system import Storage
+from formats import write_table
+from formats.price_history import PriceHistory, Indice, write_price_dataset
+from formats.information import ListedCompanies
+
+
+def migrate_price_pickles(store, batch_size = 200, remove = False):
+    '''
+    Copies every <ticker>prices.pkl under the store's data folder into the partitioned
+    Parquet price dataset, batch_size tickers per write. The pickles are only deleted
+    if remove is True. Returns a dict of ticker -> error for any files which failed.
+    '''
+    tickers = [ticker for ticker in os.listdir(store.data) 
+               if os.path.exists(PriceHistory(ticker).legacy_path(store))]
+    dataset_path = os.path.join(store.price_dataset(PriceHistory(None)), PriceHistory.dataset_name)
+    return migrate_pickles(tickers, lambda ticker: PriceHistory(ticker).legacy_path(store), 
+                           dataset_path, batch_size, remove)
+
+
+def migrate_indice_pickles(store, remove = False):
+    folder = store.indice_folder(Indice(None))
+    tickers = [filename[:-len(".pkl")] for filename in os.listdir(folder) if filename.endswith(".pkl")]
+    dataset_path = os.path.join(folder, Indice.dataset_name)
+    return migrate_pickles(tickers, lambda ticker: Indice(ticker).legacy_path(store), 
+                           dataset_path, len(tickers), remove)
+
+
+def migrate_pickles(tickers, legacy_path, dataset_path, batch_size, remove):
+    errors = {}
+    for batch_start in range(0, len(tickers), batch_size):
+        print("Migrating {} to {} of {}...".format(batch_start + 1, 
+              min(batch_start + batch_size, len(tickers)), len(tickers)))
+        frames = {}
+        for ticker in tickers[batch_start:(batch_start + batch_size)]:
+            try:
+                frames[ticker] = pandas.read_pickle(legacy_path(ticker))
+            except Exception as E:
+                errors[ticker] = "Unreadable pickle: {}".format(E)
+        if not frames:
+            continue
+        try:
+            write_price_dataset(dataset_path, frames)
+        except Exception as E:
+            for ticker in frames:
+                errors[ticker] = "Write failed: {}".format(E)
+            continue
+        if remove:
+            for ticker in frames:
+                os.remove(legacy_path(ticker))
+    return errors
+
+
+def convert_valuations(store, remove = False):
+    '''
+    Converts each Valuation*.xlsx file in the store's valuations folder to Parquet,
+    skipping any which have already been converted. The Excel files are only deleted
+    if remove is True. Returns a dict of filename -> error for any which failed.
+    '''
+    errors = {}
+    for filename in os.listdir(store.valuations):
+        if not (filename.startswith("Valuation") and filename.endswith(".xlsx")):
+            continue
+        excel_path = os.path.join(store.valuations, filename)
+        errors.update(convert_excel(excel_path, lambda path: pandas.read_excel(path, index_col = 0), remove))
+    return errors
+
+
+def convert_listed_companies(store, remove = False):
+    listed = ListedCompanies(store.exchange)
+    excel_path = listed.excel_path(store)
+    if not os.path.exists(excel_path):
+        return {}
+    return convert_excel(excel_path, lambda path: listed.load_from(path).table, remove)
+
+
+def convert_excel(excel_path, read, remove):
+    parquet_path = excel_path[:-len(".xlsx")] + ".parquet"
+    filename = os.path.basename(excel_path)
+    if not os.path.exists(parquet_path):
+        print("Converting " + filename)
+        try:
+            write_table(read(excel_path), parquet_path)
+        except Exception as E:
+            if os.path.exists(parquet_path):
+                os.remove(parquet_path)
+            return {filename : "Conversion failed: {}".format(E)}
+    if remove:
+        os.remove(excel_path)
+    return {}
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    command = args[0] if len(args) > 0 else "prices"
+    store = Storage(*args[1:3])
+    if command == "prices":
+        errors = migrate_price_pickles(store)
+    elif command == "indices":
+        errors = migrate_indice_pickles(store)
+    elif command == "valuations":
+        errors = convert_valuations(store)
+        errors.update(convert_listed_companies(store))
+    else:
+        raise ValueError("Unknown migration: " + command)
+    store.rebuild_catalog()
+    for ticker in errors:
+        print(ticker + ": " + errors[ticker])
@@ -0,0 +1,62 @@
+import queue
+import threading
+
+
+_FINISHED = object()
+
+
+def batched(items, batch_size):
+    '''
+    Yields lists of up to batch_size consecutive items.
+    '''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetched(batches, load, depth = 1):
+    '''
+    Yields load(batch) for each batch in turn. Loading runs on a background thread
+    which stays up to depth batches ahead of the consumer, so at most depth + 2
+    loaded batches are held at once. An exception raised by load is re-raised in
+    the consumer. Closing the generator early stops the background thread.
+    '''
+    loaded = queue.Queue(maxsize = depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                loaded.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load_all():
+        try:
+            for batch in batches:
+                if not put((load(batch), None)):
+                    return
+        except Exception as E:
+            put((None, E))
+        put((_FINISHED, None))
+
+    loader = threading.Thread(target = load_all, daemon = True)
+    loader.start()
+    try:
+        while True:
+            result, error = loaded.get()
+            if error is not None:
+                raise error
+            if result is _FINISHED:
+                return
+            yield result
+    finally:
+        stopped.set()
+        loader.join()
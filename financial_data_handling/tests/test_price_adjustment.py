@@ -0,0 +1,113 @@
+'''
+Checks that batched price adjustment matches adjusting each ticker on its own, and
+that incremental updates only rescale stored history for a confirmed restatement.
+Run from the financial_data_handling folder, e.g.
+    python -m pytest tests
+'''
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from download.prices import Handler
+
+
+def raw_prices(dates, adj_close):
+    close = np.full(len(dates), 10.0)
+    return pd.DataFrame({"Open" : close, "High" : close, "Low" : close, "Close" : close, 
+                         "Volume" : close * 100, "Adj Close" : adj_close}, index = pd.DatetimeIndex(dates))
+
+
+class TestPriceAdjustment(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.handler = Handler(self.location)
+        # AAA does not trade every day and has a split error (Adj Close 4x for two 
+        # bars) straight after a gap in its dates.
+        self.prices = {"AAA" : raw_prices(["2020-01-01", "2020-01-03", "2020-01-06", "2020-01-08"], 
+                                          [10.0, 40.0, 40.0, 10.0]), 
+                       "BBB" : raw_prices(pd.bdate_range("2020-01-01", "2020-01-08"), 
+                                          np.linspace(9.0, 10.0, 6)), 
+                       "CCC" : raw_prices(["2020-01-02", "2020-01-07"], [5.0, 5.0])}
+        for ticker, prices in self.prices.items():
+            self.handler.save(prices, ticker)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def adjusted_close(self, instruments, ticker):
+        cube = instruments.data
+        values = cube.as_array()[cube.tickers.index(ticker), :, cube.fields.index("Close")]
+        return pd.Series(values, index = cube.dates).dropna()
+
+    def test_cube_matches_single_ticker_adjustment(self):
+        instruments = self.handler.load_instruments(list(self.prices), workers = 1)
+        for ticker, prices in self.prices.items():
+            expected = self.handler.adjust(prices)["Close"]
+            np.testing.assert_allclose(self.adjusted_close(instruments, ticker).values, expected.values, rtol = 1e-6)
+
+    def test_result_does_not_depend_on_chunks(self):
+        tickers = list(self.prices)
+        together = self.handler.load_instruments(tickers, workers = 1, chunk_size = len(tickers))
+        apart = self.handler.load_instruments(tickers, workers = 1, chunk_size = 1)
+        self.assertEqual(together.data.tickers, apart.data.tickers)
+        np.testing.assert_array_equal(together.data.as_array(), apart.data.as_array())
+
+
+class StubHandler(Handler):
+    '''
+    Serves "downloads" from a fixed frame instead of Yahoo.
+    '''
+    def __init__(self, location, source):
+        super().__init__(location)
+        self.source = source
+
+    def get(self, ticker, start, end):
+        return self.source[start:end]
+
+
+class TestPriceUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.dates = pd.bdate_range("2020-01-01", periods = 20)
+        self.adj_close = np.linspace(9.0, 10.0, 20)
+        self.stored = raw_prices(self.dates[:15], self.adj_close[:15])
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def update(self, source):
+        handler = StubHandler(self.location, source)
+        handler.save(self.stored, "AAA")
+        self.assertEqual(handler.update("AAA", self.dates[-1]), 5)
+        return handler.load_raw("AAA")
+
+    def test_dividend_rescales_adj_close_only(self):
+        source = raw_prices(self.dates, self.adj_close)
+        source["Adj Close"] *= 0.95
+        updated = self.update(source)
+        np.testing.assert_allclose(updated["Adj Close"].values, source["Adj Close"].values)
+        np.testing.assert_allclose(updated["Close"].values, 10.0)
+        np.testing.assert_allclose(updated["Volume"].values, 1000.0)
+
+    def test_split_rescales_close_and_volume(self):
+        source = raw_prices(self.dates, self.adj_close / 2)
+        for column in ["Open", "High", "Low", "Close"]:
+            source[column] /= 2
+        source["Volume"] *= 2
+        updated = self.update(source)
+        for column in source.columns:
+            np.testing.assert_allclose(updated[column].values, source[column].values)
+
+    def test_single_revised_bar_is_not_a_restatement(self):
+        source = raw_prices(self.dates, self.adj_close)
+        source.loc[self.dates[14], "Adj Close"] *= 0.95
+        updated = self.update(source)
+        np.testing.assert_allclose(updated["Adj Close"].values[:14], self.stored["Adj Close"].values[:14])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+'''
+Checks ResponseCache and the WSJ page skipping against a local stand-in server.
+Run from the financial_data_handling folder, e.g.
+    python -m pytest tests
+'''
+import os
+import shutil
+import tempfile
+import threading
+import hashlib
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from download.financials import WebDownloader, WSJinternet, STATEMENT_SHEETS
+from download.fetch_policy import FetchPolicy
+from download.pool import DownloadPool, RateLimitedSession
+from download.response_cache import ResponseCache
+
+
+class StatementServer(BaseHTTPRequestHandler):
+    '''
+    Serves a page per path with an ETag, answering If-None-Match with 304.
+    '''
+    version = 1
+    statuses = []
+
+    def do_GET(self):
+        body = "<html><body>{} v{}</body></html>".format(self.path, self.version).encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        StatementServer.version = 1
+        StatementServer.statuses = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StatementServer)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.root = "http://127.0.0.1:{}/".format(self.server.server_port)
+        self.folder = tempfile.mkdtemp()
+        self.cache = ResponseCache(os.path.join(self.folder, "responses.sqlite"))
+        self.session = RateLimitedSession(FetchPolicy(None))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache.close()
+        shutil.rmtree(self.folder)
+
+    def test_first_fetch_downloads_page(self):
+        page = self.cache.fetch(self.session, self.root + "page")
+        self.assertEqual(StatementServer.statuses, [200])
+        self.assertIn(b"v1", page.content)
+        self.assertFalse(page.unchanged)
+
+    def test_refetch_is_conditional(self):
+        first = self.cache.fetch(self.session, self.root + "page")
+        second = self.cache.fetch(self.session, self.root + "page")
+        self.assertEqual(StatementServer.statuses, [200, 304])
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second.content_hash, first.content_hash)
+        self.assertEqual(self.cache.not_modified, 1)
+
+    def test_processed_page_is_unchanged_until_it_changes(self):
+        url = self.root + "page"
+        page = self.cache.fetch(self.session, url)
+        self.cache.mark_processed(url, page.content)
+        self.assertTrue(self.cache.fetch(self.session, url).unchanged)
+        StatementServer.version = 2
+        changed = self.cache.fetch(self.session, url)
+        self.assertEqual(StatementServer.statuses, [200, 304, 200])
+        self.assertFalse(changed.unchanged)
+        self.assertIn(b"v2", changed.content)
+
+    def test_unchanged_pages_are_skipped(self):
+        downloader = WebDownloader.__new__(WebDownloader)
+        downloader.pool = DownloadPool(2, policy = FetchPolicy(None))
+        downloader.WSJ = WSJinternet(session = downloader.pool.session, cache = self.cache)
+        downloader.WSJ.page_root = self.root
+        fetched = list(downloader.fetchStatementPages(["AAA"], ["annual"]))
+        self.assertEqual([(ticker, period) for ticker, period, pages in fetched], [("AAA", "annual")])
+        downloader.markProcessed(fetched)
+        self.assertEqual(list(downloader.fetchStatementPages(["AAA"], ["annual"])), [])
+        self.assertEqual(StatementServer.statuses.count(304), len(STATEMENT_SHEETS))
+
+    def test_failed_pages_are_not_marked(self):
+        downloader = WebDownloader.__new__(WebDownloader)
+        downloader.WSJ = WSJinternet(session = self.session, cache = self.cache)
+        downloader.WSJ.page_root = self.root
+        urls = [downloader.WSJ.get_address("AAA", sheet, "annual") for sheet in STATEMENT_SHEETS]
+        for url in urls:
+            self.cache.fetch(self.session, url)
+        pages = {sheet : (None, IOError("Page load error")) for sheet in STATEMENT_SHEETS}
+        downloader.markProcessed([("AAA", "annual", pages)])
+        for url in urls:
+            self.assertIsNone(self.cache.lookup(url)[3])
+            self.assertFalse(self.cache.fetch(self.session, url).unchanged)
+
+
+if __name__ == "__main__":
+    unittest.main()